@@ -3,6 +3,24 @@
 """
 from enum import IntEnum
 
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+# Names and versions repeat across machines, keep a single copy of each
+_INTERNED = {}
+# Entries the table is cleared at, strings interned before stay shared by the objects holding them
+_INTERNED_LIMIT = 1 << 16
+
+
+def _intern(value):
+    if value is None:
+        return None
+    if len(_INTERNED) >= _INTERNED_LIMIT:
+        _INTERNED.clear()
+    return _INTERNED.setdefault(value, value)
+
 
 class MachineType(IntEnum):
     Default = 0
@@ -25,11 +43,12 @@ class StorageFormat(IntEnum):
 
 
 class NameVersion(object):
+    __slots__ = ('_name', '_version')
     _NAME = 'NameVersion'
 
     def __init__(self, name, version):
-        self._name = name
-        self._version = version
+        self._name = _intern(name)
+        self._version = _intern(version)
 
     @property
     def name(self):
@@ -42,22 +61,70 @@ class NameVersion(object):
     def _to_dict(self):
         return {'name': self.name, 'version': self.version}
 
+    @classmethod
+    def _from_dict(cls, data):
+        return cls(data['name'], data['version'])
+
     def __repr__(self):
         return '<{_name} name={name}, version={version}>'.format(_name=self._NAME, name=self.name, version=self.version)
 
 
 class OperatingSystem(NameVersion):
+    __slots__ = ()
     _NAME = 'OperatingSystem'
 
 
 class Package(NameVersion):
+    __slots__ = ()
     _NAME = 'Package'
 
 
+class PackageList(Sequence):
+    """
+    Read-only view presenting the package table of an `Installation` as `Package` objects
+    """
+    __slots__ = ('_names', '_versions')
+
+    def __init__(self, names, versions):
+        self._names = names
+        self._versions = versions
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Package(name, version) for name, version in zip(self._names[index], self._versions[index])]
+        return Package(self._names[index], self._versions[index])
+
+    def __iter__(self):
+        for name, version in zip(self._names, self._versions):
+            yield Package(name, version)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class Installation(object):
+    """
+    Operating system and installed packages of a machine
+
+    Packages are kept as a table of interned name and version columns, `packages`
+    can be given as `Package` objects or (name, version) pairs.
+    """
+    __slots__ = ('_os', '_names', '_versions')
+
     def __init__(self, os, packages):
         self._os = os
-        self._packages = packages
+        self._names = []
+        self._versions = []
+        for pkg in packages:
+            if isinstance(pkg, NameVersion):
+                name, version = pkg.name, pkg.version
+            else:
+                name, version = pkg
+            self._names.append(_intern(name))
+            self._versions.append(_intern(version))
 
     @property
     def os(self):
@@ -65,16 +132,23 @@ class Installation(object):
 
     @property
     def packages(self):
-        return self._packages
+        return PackageList(self._names, self._versions)
 
     def _to_dict(self):
-        return {'os': self.os._to_dict(), 'packages': [pkg._to_dict() for pkg in self.packages]}
+        return {'os': self.os._to_dict(),
+                'packages': [{'name': name, 'version': version} for name, version in zip(self._names, self._versions)]}
+
+    @classmethod
+    def _from_dict(cls, data):
+        return cls(OperatingSystem._from_dict(data['os']), [(pkg['name'], pkg['version']) for pkg in data['packages']])
 
     def __repr__(self):
         return '<Installation os={os}, packages={packages}>'.format(**self._to_dict())
 
 
 class Disk(object):
+    __slots__ = ('_disk_type', '_host_path', '_device', '_storage_format')
+
     def __init__(self, dt, host_path, device, sf):
         self._disk_type = dt
         self._host_path = host_path
@@ -101,6 +175,10 @@ class Disk(object):
         return {'type': self.disk_type, 'format': self.storage_format,
                 'host_path': self.host_path, 'device': self.device}
 
+    @classmethod
+    def _from_dict(cls, data):
+        return cls(data['type'], data['host_path'], data['device'], data['format'])
+
     def __repr__(self):
         arg = {'type': self.disk_type, 'format': self.storage_format,
                'host_path': self.host_path, 'device': self.device}
@@ -109,6 +187,7 @@ class Disk(object):
 
 
 class Machine(object):
+    __slots__ = ('_id', '_hostname', '_ip', '_arch', '_type', '_disks', '_provider', '_name', '_installation')
 
     _NAME = 'Machine'
 
@@ -175,6 +254,12 @@ class Machine(object):
                 'disks': [d._to_dict() for d in self.disks], 'name': self.name,
                 'os': self.installation._to_dict()}
 
+    @classmethod
+    def _from_dict(cls, data, provider=None):
+        return cls(data['id'], data['hostname'], data['ip'], data['arch'], data['type'],
+                   [Disk._from_dict(d) for d in data['disks']], data['name'],
+                   Installation._from_dict(data['os']), provider)
+
     def __repr__(self):
         arg = {'id': self.id, 'hostname': self.hostname, 'ip': self.ip,
                'arch': self.arch, 'type': self.type, '_name': self._NAME,
@@ -183,10 +268,26 @@ class Machine(object):
         return msg.format(**arg)
 
 
+class MachineLookupError(Exception):
+    pass
+
+
 class AbstractMachineProvider(object):
-    def get_machines(self):
+    def get_machines(self, patterns=None):
         """
 
+        :param patterns: List[str], only machines matching any of these glob patterns are returned
         :return: List[AbstractMachine], list of all virtual machines
         """
         raise NotImplementedError
+
+    def find_machine(self, name):
+        """
+
+        :param name: str, name, id, hostname or IP address of the machine
+        :return: AbstractMachine, matching machine or None
+        """
+        for machine in self.get_machines():
+            if name in (machine.name, machine.id, machine.hostname) or name in machine.ip:
+                return machine
+        return None
@@ -0,0 +1,242 @@
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+CACHE_DIR = '/var/lib/leapp/cache/'
+INVENTORY_CACHE_PATH = os.path.join(CACHE_DIR, 'inventory.json')
+PACKAGE_CACHE_DIR = os.path.join(CACHE_DIR, 'packages')
+AGENT_KEY_MEMO_PATH = os.path.join(CACHE_DIR, 'agent_keys.json')
+DEFAULT_INVENTORY_TTL = 600
+
+
+def _load_json(path, default):
+    """
+    Load JSON document from `path`
+
+    :param path: str, path of the JSON file
+    :param default: value returned when the file is missing or unreadable
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def _save_json(path, data):
+    """
+    Atomically replace `path` with JSON serialized `data`
+
+    Failures are ignored, as a cache which can't be written is just a cache miss
+    for the next run (e.g. when leapp-tool runs unprivileged).
+
+    :param path: str, path of the JSON file
+    :param data: JSON serializable data
+    :return: bool, True if the data was written
+    """
+    directory = os.path.dirname(path)
+    try:
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def domain_fingerprint(xml_desc):
+    """
+    Hash of the libvirt domain XML description
+
+    :param xml_desc: str, result of `virDomain.XMLDesc()`
+    :return: str, hex digest
+    """
+    if not isinstance(xml_desc, bytes):
+        xml_desc = xml_desc.encode('utf-8')
+    return hashlib.sha1(xml_desc).hexdigest()
+
+
+class InventoryCache(object):
+    """
+    On-disk cache of inspected machines keyed by domain UUID and domain XML fingerprint
+
+    Entries older than `ttl` seconds are ignored. With `refresh` set, lookups always
+    miss, but freshly inspected machines are still stored.
+    """
+
+    _VERSION = 2
+
+    def __init__(self, path=INVENTORY_CACHE_PATH, ttl=DEFAULT_INVENTORY_TTL, refresh=False):
+        self._path = path
+        self._ttl = ttl
+        self._refresh = refresh
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+
+    @property
+    def entries(self):
+        with self._lock:
+            if self._entries is None:
+                data = _load_json(self._path, {})
+                entries = data.get('machines', {}) if data.get('version') == self._VERSION else {}
+                now = time.time()
+                self._entries = dict((uuid, entry) for uuid, entry in entries.items()
+                                     if now - entry.get('timestamp', 0) <= self._ttl)
+            return self._entries
+
+    def lookup(self, uuid, fingerprint, depth):
+        """
+        Get cached machine description
+
+        Entries of a more detailed scan also satisfy lookups for less detailed ones, the package
+        list is dropped then.
+
+        :param uuid: str, domain UUID
+        :param fingerprint: str, domain XML fingerprint
+        :param depth: int, required level of detail (see `LibvirtMachineProvider.SCAN_*`)
+        :return: dict, machine description as produced by `Machine._to_dict` or None
+        """
+        if self._refresh:
+            return None
+        entry = self.entries.get(uuid)
+        if not entry or entry['fingerprint'] != fingerprint or entry['depth'] < depth:
+            return None
+        machine = entry['machine']
+        if entry['depth'] > depth and machine['os']['packages']:
+            machine = dict(machine, os=dict(machine['os'], packages=[]))
+        return machine
+
+    def store(self, uuid, fingerprint, depth, machine):
+        """
+        Remember machine description
+
+        :param uuid: str, domain UUID
+        :param fingerprint: str, domain XML fingerprint
+        :param depth: int, level of detail of the description (see `LibvirtMachineProvider.SCAN_*`)
+        :param machine: dict, machine description as produced by `Machine._to_dict`
+        """
+        entries = self.entries
+        with self._lock:
+            entries[uuid] = {'fingerprint': fingerprint, 'depth': depth,
+                             'timestamp': time.time(), 'machine': machine}
+            self._dirty = True
+
+    def save(self):
+        """
+        Write the cache back to disk if it was modified
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            _save_json(self._path, {'version': self._VERSION, 'machines': self._entries})
+            self._dirty = False
+
+
+class PackageCache(object):
+    """
+    On-disk cache of package inventories keyed by machine identity and rpmdb fingerprint
+
+    The fingerprint changes with every rpm transaction, so entries never expire.
+    """
+
+    def __init__(self, path=PACKAGE_CACHE_DIR):
+        self._path = path
+
+    def _entry_path(self, identity):
+        if not isinstance(identity, bytes):
+            identity = identity.encode('utf-8')
+        return os.path.join(self._path, hashlib.sha1(identity).hexdigest() + '.json')
+
+    def lookup(self, identity, fingerprint):
+        """
+        Get cached package inventory
+
+        :param identity: str, machine identity (machine-id or hostname)
+        :param fingerprint: str, rpmdb fingerprint reported by the machine
+        :return: List[Tuple[str, str]], package names and versions or None
+        """
+        if not fingerprint:
+            return None
+        entry = _load_json(self._entry_path(identity), {})
+        if entry.get('fingerprint') != fingerprint:
+            return None
+        return entry['packages']
+
+    def store(self, identity, fingerprint, packages):
+        """
+        Remember package inventory
+
+        :param identity: str, machine identity (machine-id or hostname)
+        :param fingerprint: str, rpmdb fingerprint reported by the machine
+        :param packages: List[Tuple[str, str]], package names and versions
+        """
+        if fingerprint:
+            _save_json(self._entry_path(identity), {'fingerprint': fingerprint, 'packages': packages})
+
+
+class AgentKeyMemo(object):
+    """
+    On-disk record of the SSH agent key each destination accepted last
+
+    Destinations never connected to before get the key accepted last by any destination, as one key
+    usually opens all machines of a fleet. The record is read on the first lookup and written by `save`.
+    """
+
+    def __init__(self, path=AGENT_KEY_MEMO_PATH):
+        self._path = path
+        self._lock = threading.Lock()
+        self._data = None
+        self._dirty = False
+
+    def _load(self):
+        if self._data is None:
+            data = _load_json(self._path, {})
+            self._data = {'last': data.get('last'), 'destinations': data.get('destinations', {})}
+        return self._data
+
+    def lookup(self, destination):
+        """
+        :param destination: str, user, host and port connected to
+        :return: str, hex fingerprint of the key to try first or None
+        """
+        with self._lock:
+            data = self._load()
+            return data['destinations'].get(destination, data['last'])
+
+    def store(self, destination, fingerprint):
+        """
+        :param destination: str, user, host and port connected to
+        :param fingerprint: str, hex fingerprint of the accepted key
+        """
+        with self._lock:
+            data = self._load()
+            if data['destinations'].get(destination) != fingerprint or data['last'] != fingerprint:
+                data['destinations'][destination] = fingerprint
+                data['last'] = fingerprint
+                self._dirty = True
+
+    def save(self):
+        """
+        Write the record back to disk if it was modified
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            _save_json(self._path, self._data)
+            self._dirty = False
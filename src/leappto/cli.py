@@ -4,25 +4,34 @@ from __future__ import print_function
 from argparse import ArgumentParser
 from getpass import getpass
 from grp import getgrnam, getgrgid
-from json import dumps
+from json import dumps, loads
 from pwd import getpwuid
 from subprocess import Popen, PIPE
 from collections import OrderedDict
-from leappto import Machine
-from leappto.driver.ssh import SSHConnectionError
-from leappto.providers.libvirt import LibvirtMachineProvider
-from leappto.providers.ssh import SSHMachine
+from leappto import Machine, MachineLookupError
+from leappto.cache import InventoryCache, PackageCache, DEFAULT_INVENTORY_TTL
+from leappto.dedup import DEDUP_DIRS, COLLECT_GARBAGE_COMMAND, dedup_command, parse_dedup_output
+from leappto.driver.instrumentation import INSTRUMENTATION
+from leappto.driver import DriverError
+from leappto.driver.ssh import SSHError, SSHConnectionError, SSH_CTL_PATH, SSH_CONTROL_PATH, SSH_CONTROL_PERSIST
+from leappto.providers.libvirt import LibvirtMachineProvider, LiveLibvirtMachineProvider
+from leappto.providers.ssh import InspectionError, SSHMachine, inspect_hosts
 from leappto.providers.local import LocalMachine
+from leappto.utils import balanced_partition, expand_addresses, matches_any, MAX_NETWORK_HOSTS
 from leappto.version import __version__
 from sets import Set
 import argcomplete
+import atexit
 import os
 import sys
 import socket
 import nmap
 import shlex
 import errno
+import itertools
 import psutil
+import re
+import time
 
 
 VERSION='leapp-tool {0}'.format(__version__)
@@ -40,6 +49,27 @@ UPSTART_SERVICE_BLACKLIST = (
 
 MACROCONTAINER_STORAGE_DIR = '/var/lib/leapp/macrocontainers/'
 SOURCE_APP_EXPORT_DIR = '/var/lib/leapp/source_export/'
+# Progress journals of migrations, not in MACROCONTAINER_STORAGE_DIR where every entry is taken for a container
+MIGRATION_JOURNAL_DIR = '/var/lib/leapp/journals/'
+# Directories whose subdirectories become shards of a parallel copy, other top level directories are shards themselves
+RSYNC_SPLIT_DIRS = ('/usr', '/var', '/home')
+# Paths which are safe to pass to rsync unquoted, others are left to the final pass
+_SHARD_PATH_RE = re.compile(r'^(/[\w.+@,-]+)+$')
+# Seconds the disk usage of the shards is summed up for, trees taking longer are taken for large ones
+_ESTIMATE_TIMEOUT = 10
+# Exit status of rsync when files vanished on the source, everything else was transferred
+_RSYNC_VANISHED = 24
+# Exit status of rsync when some files were not transferred
+_RSYNC_NOT_TRANSFERRED = 23
+# Exit statuses of rsync which only report files vanished or not transferred, in order of severity
+_RSYNC_PARTIAL = (_RSYNC_VANISHED, _RSYNC_NOT_TRANSFERRED)
+# Most recently migrated containers unchanged files are hard linked from rather than transferred
+_LINK_DEST_LIMIT = 5
+# Counters of `rsync --stats`, rsync 3.0 doesn't say "regular" and newer versions group digits
+_RSYNC_STATS_RE = {
+    'files': re.compile(r'^Number of (?:regular )?files transferred: ([\d,.]+)', re.MULTILINE),
+    'bytes': re.compile(r'^Total transferred file size: ([\d,.]+) bytes', re.MULTILINE),
+}
 _LOCALHOST='localhost'
 _MIN_PORT = 1
 _MAX_PORT = 65535
@@ -79,9 +109,66 @@ def _add_identity_options(cli_cmd, context=''):
         cli_cmd.add_argument('--ask-pass', '-k', action='store_true', help='Ask for SSH password')
         cli_cmd.add_argument('--user', '-u', default=None, help='Connect as this user')
 
+def _add_inventory_options(cli_cmd):
+    cli_cmd.add_argument('--inspect-via', default=LibvirtMachineProvider.INSPECT_AUTO,
+                         choices=[LibvirtMachineProvider.INSPECT_AUTO, LibvirtMachineProvider.INSPECT_SSH,
+                                  LibvirtMachineProvider.INSPECT_AGENT],
+                         help='Inspect virtual machines over SSH or the qemu guest agent, '
+                              'auto prefers the agent when it is connected')
+    cache_group = cli_cmd.add_mutually_exclusive_group()
+    cache_group.add_argument('--cached', action='store_true',
+                             help='Reuse cached inspection results of unchanged virtual machines')
+    cache_group.add_argument('--refresh', action='store_true',
+                             help='Inspect all virtual machines and refresh the inventory cache')
+    cli_cmd.add_argument('--cache-ttl', type=int, default=DEFAULT_INVENTORY_TTL,
+                         help='Maximum age of cached inspection results in seconds')
+
+def _write_metrics(path):
+    summary = dumps(INSTRUMENTATION.summary(), indent=3)
+    if path == '-':
+        sys.stderr.write(summary + '\n')
+    else:
+        with open(path, 'w') as f:
+            f.write(summary + '\n')
+
+def _merge_rsync_status(statuses):
+    """
+    Combine exit statuses of rsync runs into the most severe one
+
+    Errors are more severe than partial transfers (23), which are more severe than files
+    vanishing during the copy (24), the first error wins.
+
+    :param statuses: Iterable[int], exit statuses
+    :return: int
+    """
+    merged = 0
+    for status in statuses:
+        if status == 0 or merged not in (0,) + _RSYNC_PARTIAL:
+            continue
+        if merged == 0 or status not in _RSYNC_PARTIAL or _RSYNC_PARTIAL.index(status) > _RSYNC_PARTIAL.index(merged):
+            merged = status
+    return merged
+
+
+def _parse_rsync_stats(output):
+    """
+    :param output: bytes, output of `rsync --stats`
+    :return: Dict[str, int], number of `files` transferred and their size in `bytes`
+    """
+    output = output.decode('utf-8', 'replace')
+    stats = {}
+    for name, pattern in _RSYNC_STATS_RE.items():
+        match = pattern.search(output)
+        stats[name] = int(re.sub(r'[,.]', '', match.group(1))) if match else 0
+    return stats
+
+
 def _make_argument_parser():
     ap = ArgumentParser()
     ap.add_argument('-v', '--version', action='version', version=VERSION, help='display version information')
+    ap.add_argument('--metrics', metavar='PATH', default=None,
+                    help='On exit write timings, byte counts and exit codes of remote commands per host and per '
+                         'command as JSON to PATH, - for standard error output')
     parser = ap.add_subparsers(help='sub-command', dest='action')
 
     list_cmd = parser.add_parser('list-machines', help='list running virtual machines and some information')
@@ -89,10 +176,25 @@ def _make_argument_parser():
     check_target_cmd = parser.add_parser('check-target', help='check for claimed names on target container host')
     destroy_cmd = parser.add_parser('destroy-container', help='destroy named container on virtual machine')
     scan_ports_cmd = parser.add_parser('port-inspect', help='scan ports on virtual machine')
-    list_cmd.add_argument('--shallow', action='store_true', help='Skip detailed scans of VM contents')
-    list_cmd.add_argument('pattern', nargs='*', default=['*'], help='list machines matching pattern')
+    list_cmd.add_argument('--shallow', action='store_true',
+                          help='Skip detailed scans of VM contents, virtual machines are not connected to')
+    list_cmd.add_argument('pattern', nargs='*', default=['*'],
+                          help='list machines whose name, UUID or hostname matches pattern')
     list_cmd.add_argument('--user', '-u', default=None, help='Username to to be used by the scan')
-    list_cmd.add_argument('--ip', nargs='*', default=None, help='list of IPs to scan')
+    list_cmd.add_argument('--ip', nargs='*', default=None,
+                          help='list of IPs, hostnames, CIDR networks or @files with one entry per line to scan')
+    list_cmd.add_argument('--max-network-hosts', type=int, default=MAX_NETWORK_HOSTS,
+                          help='Refuse --ip networks with more hosts than this (default: %(default)s)')
+    list_cmd.add_argument('--timeout', type=float, default=None,
+                          help='Maximum number of seconds spent on inspecting a single machine')
+    list_cmd.add_argument('--stream', action='store_true',
+                          help='Print each --ip machine as a JSON document on its own line as soon as it is inspected')
+    list_cmd.add_argument('--no-package-cache', action='store_true',
+                          help='Always transfer the full package inventory, even if the rpmdb is unchanged')
+    list_cmd.add_argument('--jobs', '-j', type=int, default=1, help='Number of machines to inspect concurrently')
+    list_cmd.add_argument('--watch', action='store_true',
+                          help='Keep running and print the machine list whenever a virtual machine starts or stops')
+    _add_inventory_options(list_cmd)
 
     def _port_spec(arg):
         """Converts a port forwarding specifier to a (host_port, container_port) tuple
@@ -166,17 +268,37 @@ def _make_argument_parser():
         action='store_true',
         help='force creation of new target container, even if one already exists'
     )
+    migrate_cmd.add_argument('--resume', action='store_true',
+                             help='Continue an interrupted migration to the container, skipping the work it completed')
     migrate_cmd.add_argument('--freeze-fs', default=False, action="store_true", help='Freeze filesystem on source machine')
+    migrate_cmd.add_argument('--direct-copy', default=False, action='store_true',
+                             help='Let a remote target pull the filesystem straight from the source over the '
+                                  'forwarded SSH agent instead of staging it on this machine')
+    migrate_cmd.add_argument('--pre-copy', default=False, action='store_true',
+                             help='Copy the filesystem while the source is live until the changes converge, '
+                                  'only the last pass runs with the filesystem frozen')
+    migrate_cmd.add_argument('--pre-copy-passes', type=int, default=5, metavar='N',
+                             help='Maximum number of pre-copy passes (default: 5)')
+    migrate_cmd.add_argument('--pre-copy-threshold', type=int, default=64, metavar='MiB',
+                             help='Stop pre-copying once a pass transfers no more than this (default: 64)')
+    migrate_cmd.add_argument('--dedup', default=False, action='store_true',
+                             help='Share files of {} which are identical to those of other containers on '
+                                  'the target by hard links'.format(', '.join('/' + d for d in DEDUP_DIRS)))
+    migrate_cmd.add_argument('--rsync-jobs', type=int, default=1, metavar='N',
+                             help='Split the filesystem into N size balanced shards copied by parallel rsync processes')
     _add_identity_options(migrate_cmd, context='source')
     _add_identity_options(migrate_cmd, context='target')
+    _add_inventory_options(migrate_cmd)
 
     check_target_cmd.add_argument('-t', '--target', default='localhost', help='Target container host')
     _add_identity_options(check_target_cmd)
+    _add_inventory_options(check_target_cmd)
     check_target_cmd.add_argument("-s", "--status", default=False, help='Check for services status on target machine', action="store_true")
 
     destroy_cmd.add_argument('-t', '--target', default='localhost', help='Target container host')
     destroy_cmd.add_argument('container', help='container to destroy (if it exists)')
     _add_identity_options(destroy_cmd)
+    _add_inventory_options(destroy_cmd)
 
     scan_ports_cmd.add_argument('address', help='virtual machine address')
     scan_ports_cmd.add_argument(
@@ -201,17 +323,22 @@ def main():
     ap = _make_argument_parser()
 
     # TODO: Move these helper functions into the leappto library
-    def _find_machine(ms, name, shallow=True, user='root'):
-        for machine in ms:
-            if machine.hostname == name:
+    def _find_machine(provider, name, shallow=True, user='root'):
+        if name not in ('localhost', '127.0.0.1'):
+            try:
+                machine = provider.find_machine(name)
+            except MachineLookupError as e:
+                print('! {}'.format(e))
+                return None
+            if machine:
                 return machine
         return _inspect_machine(name, shallow=shallow, user=user)
 
-    def _inspect_machine(host, shallow=True, user='root'):
+    def _inspect_machine(host, shallow=True, user='root', package_cache=None, timeout=None):
         try:
             if host in ('localhost', '127.0.0.1'):
-                return LocalMachine(shallow_scan=shallow)
-            return SSHMachine(host, user=user, shallow_scan=shallow)
+                return LocalMachine(shallow_scan=shallow, package_cache=package_cache)
+            return SSHMachine(host, user=user, shallow_scan=shallow, package_cache=package_cache, timeout=timeout)
         except SSHConnectionError as e:
             print("SSH error: {0}".format(e))
             return None
@@ -220,6 +347,14 @@ def main():
             traceback.print_exc()
             return None
 
+    def _make_inventory_cache(parsed):
+        if not (parsed.cached or parsed.refresh):
+            return None
+        return InventoryCache(ttl=parsed.cache_ttl, refresh=parsed.refresh)
+
+    def _make_machine_provider(parsed, provider_class=LibvirtMachineProvider, **kwargs):
+        return provider_class(cache=_make_inventory_cache(parsed), inspector=parsed.inspect_via, **kwargs)
+
     def _set_ssh_config(username, identity, use_sshpass=False):
         settings = {
             'StrictHostKeyChecking': 'no',
@@ -246,11 +381,23 @@ def main():
         SOURCE = 'source'
         TARGET = 'target'
 
-        _SSH_CTL_PATH = '{}/.ssh/ctl'.format(os.environ['HOME'])
-        _SSH_CONTROL_PATH = '-o ControlPath="{}/%L-%r@%h:%p"'.format(_SSH_CTL_PATH)
+        # Phases of a migration recorded in its journal, in order
+        PHASE_PULL = 'pull'
+        PHASE_PUSH = 'push'
+        PHASE_PROVISION = 'provision'
+        PHASE_DONE = 'done'
+
+        _SSH_CTL_PATH = SSH_CTL_PATH
+        _SSH_CONTROL_PATH = '-o ControlPath="{}"'.format(SSH_CONTROL_PATH)
+        # All ssh calls to a machine share one master connection, which stays around for
+        # _SSH_CONTROL_PERSIST seconds after its last use
+        _SSH_CONTROL_PERSIST = SSH_CONTROL_PERSIST
+        _SSH_SHARED_CONN = [_SSH_CONTROL_PATH, '-o ControlMaster=auto',
+                            '-o ControlPersist={}'.format(_SSH_CONTROL_PERSIST)]
 
         def __init__(self, target, target_ssh_cfg, disk, source=None, source_ssh_cfg=None,
-                     rsync_cp_backend=False, container_name=None, excluded_paths=None):
+                     rsync_cp_backend=False, container_name=None, excluded_paths=None, direct_copy=False,
+                     rsync_jobs=1):
             self.source = source
             self.target = target
             self.source_use_sshpass, self.source_cfg = (None, None) if source_ssh_cfg is None else source_ssh_cfg
@@ -259,8 +406,14 @@ def main():
             self.disk = disk
             self.rsync_cp_backend = rsync_cp_backend
             self.container_name = container_name
+            self.direct_copy = direct_copy
+            self.rsync_jobs = rsync_jobs
 
             self.freeze = False
+            self.dedup = False
+            self.pre_copy_passes = 0
+            self.pre_copy_threshold = 0
+            self.journal = None
 
             if excluded_paths is None:
                 # Default excluded paths used only when --exclude-path wasn't used
@@ -273,6 +426,19 @@ def main():
         def freeze_fs(self, enabled = True):
             self.freeze = enabled
 
+        def deduplicate(self, enabled=True):
+            self.dedup = enabled
+
+        def pre_copy(self, passes, threshold):
+            """
+            Copy the live source in up to `passes` passes before the final one
+
+            Pre-copying stops early once a pass transfers no more than `threshold` bytes or
+            transfers no less than the pass before, i.e. the changes don't converge.
+            """
+            self.pre_copy_passes = passes
+            self.pre_copy_threshold = threshold
+
         def __get_machine_opt_by_context(self, machine_context):
             return (getattr(self, '{}_{}'.format(machine_context, opt)) for opt in ['addr', 'cfg', 'use_sshpass'])
 
@@ -297,7 +463,10 @@ def main():
                 return []
             return ['ssh'] + cfg + ['-4', addr]
 
-        def _ssh_make_child(self, cmd, machine_context=None, reuse_ssh_conn=False, **kwargs):
+        def _target_is_local(self):
+            return self.target_addr in ('127.0.0.1', _LOCALHOST)
+
+        def _ssh_make_child(self, cmd, machine_context=None, reuse_ssh_conn=True, forward_agent=False, **kwargs):
             if machine_context is None:
                 machine_context = self.TARGET
             machine = getattr(self, machine_context, None)
@@ -305,8 +474,13 @@ def main():
                 return Popen(shlex.split(cmd), **kwargs)
             addr, cfg, use_sshpass = self.__get_machine_opt_by_context(machine_context)
             ssh_cmd = self._ssh_base(addr, cfg)
-            if reuse_ssh_conn:
-                ssh_cmd += [self._SSH_CONTROL_PATH]
+            if forward_agent:
+                # A master started without agent forwarding refuses to forward the agent for its
+                # clients, the other calls have opened one already, so this one connects on its own
+                ssh_cmd += ['-o ControlPath=none', '-A']
+            elif reuse_ssh_conn:
+                self._make_ctl_dir()
+                ssh_cmd += self._SSH_SHARED_CONN
             ssh_cmd += [cmd]
             if use_sshpass:
                 return self._sshpass(ssh_cmd, **kwargs)
@@ -315,14 +489,22 @@ def main():
         def _ssh(self, cmd, **kwargs):
             return self._ssh_make_child(cmd, **kwargs).wait()
 
-        def _open_permanent_ssh_conn(self, machine_context):
-            addr, cfg, _ = self.__get_machine_opt_by_context(machine_context)
+        def _make_ctl_dir(self):
             if not os.path.exists(self._SSH_CTL_PATH):
                 try:
                     os.makedirs(self._SSH_CTL_PATH)
                 except OSError as exc:
                     if exc.errno != errno.EEXIST:
                         raise
+
+        def _open_permanent_ssh_conn(self, machine_context):
+            addr, cfg, _ = self.__get_machine_opt_by_context(machine_context)
+            self._make_ctl_dir()
+            check_cmd = 'ssh {} {} -O check {}'.format(self._SSH_CONTROL_PATH, ' '.join(cfg), addr)
+            with open(os.devnull, 'w') as devnull:
+                if Popen(shlex.split(check_cmd), stdout=devnull, stderr=devnull).wait() == 0:
+                    # A shared master connection is already running
+                    return 0
             cmd = ' '.join(self._ssh_base(addr, ['-nNf -o ControlMaster=yes', self._SSH_CONTROL_PATH] + cfg))
             return Popen(shlex.split(cmd)).wait()
 
@@ -352,8 +534,7 @@ def main():
 
         def _ssh_out(self, cmd, machine_context=None, **kwargs):
             """Capture SSH command output in addition to return code"""
-            child = self._ssh_make_child(cmd, machine_context=machine_context,
-                                         reuse_ssh_conn=False, stdout=PIPE, stderr=PIPE)
+            child = self._ssh_make_child(cmd, machine_context=machine_context, stdout=PIPE, stderr=PIPE)
             output, err_output = child.communicate()
             if err_output:
                 sys.stderr.write(err_output + b"\n")
@@ -372,21 +553,259 @@ def main():
             container_name = self.get_target_container_name()
             return os.path.join(MACROCONTAINER_STORAGE_DIR, container_name)
 
+        def _journal_path(self, container_name=None):
+            return os.path.join(MIGRATION_JOURNAL_DIR, (container_name or self.get_target_container_name()) + '.json')
+
+        def load_journal(self):
+            """
+            Read the journal of an earlier migration to the container from the target
+
+            :return: dict, the journal, None if there is none
+            """
+            rc, output = self._ssh_sudo_out('cat "{}" 2>/dev/null'.format(self._journal_path()),
+                                            machine_context=self.TARGET)
+            if rc != 0 or not output.strip():
+                return None
+            try:
+                return loads(output.decode('utf-8'))
+            except ValueError:
+                return None
+
+        def start_journal(self, journal=None):
+            """
+            Record the progress of the migration in a journal on the target from now on
+
+            :param journal: dict, journal of an interrupted migration to continue, a new one is started if None
+            """
+            if journal is None:
+                journal = {'container': self.get_target_container_name(), 'source': self.source_addr,
+                           'phase': self.PHASE_PULL, 'shards': None, 'completed': {}, 'port_map': None,
+                           'dedup': self.dedup}
+            self.journal = journal
+            return self._save_journal()
+
+        def checkpoint(self, **changes):
+            """
+            Update the journal with `changes` and write it to the target, nothing happens without a journal
+            """
+            if self.journal is None:
+                return 0
+            self.journal.update(changes)
+            return self._save_journal()
+
+        def _save_journal(self):
+            self.journal['updated'] = time.time()
+            path = self._journal_path()
+            # Written aside and renamed, so an interruption never leaves a truncated journal behind
+            cmd = 'mkdir -p "{0}" && cat > "{1}.tmp" && mv "{1}.tmp" "{1}"'.format(MIGRATION_JOURNAL_DIR, path)
+            child = self._ssh_make_child("sudo bash -c '{}'".format(cmd), stdin=PIPE)
+            child.communicate(dumps(self.journal).encode('utf-8'))
+            return child.returncode
+
+        def _shard_completed(self, step, index, status):
+            # Files not transferred are retried on resume, vanished files are gone for good
+            if step is None or self.journal is None or status not in (0, _RSYNC_VANISHED):
+                return
+            completed = self.journal['completed'].setdefault(step, [])
+            completed.append(index)
+            self.checkpoint(completed=self.journal['completed'])
+
+        def _link_dest_options(self):
+            """
+            rsync options hard linking unchanged files from the most recently migrated containers on the target
+
+            Only containers migrated with deduplication qualify, others label their files privately.
+            """
+            rc, containers = self.check_target_containers()
+            if rc != 0:
+                return ''
+            journals_cmd = 'grep -l "\\"dedup\\": true" {}*.json 2>/dev/null | xargs -r ls -1t'.format(
+                MIGRATION_JOURNAL_DIR)
+            _, output = self._ssh_sudo_out(journals_cmd, machine_context=self.TARGET)
+            names = [os.path.basename(path)[:-len('.json')] for path in output.decode('utf-8', 'replace').splitlines()]
+            names = [name for name in names if name in containers and name != self.get_target_container_name()]
+            return ' '.join('--link-dest=' + os.path.join(MACROCONTAINER_STORAGE_DIR, name)
+                            for name in names[:_LINK_DEST_LIMIT])
+
+        def dedup_container(self):
+            """
+            Hard link the read-mostly files of the container to the object store on the target
+
+            :return: int, exit status
+            """
+            # The command quotes with single quotes, it can't run within `sudo bash -c '...'`
+            rc, output = self._ssh_out('sudo ' + dedup_command(self._get_container_dir()), machine_context=self.TARGET)
+            stats = parse_dedup_output(output)
+            if rc != 0 or stats is None:
+                print('! deduplication failed')
+                return rc or 1
+            print('! deduplicated {linked} of {files} files, {bytes} bytes saved, {errors} errors'.format(**stats))
+            return 0
+
+        def _estimate_shards(self):
+            """
+            Quick estimate of the disk usage of the shards a parallel copy is split into
+
+            The trees are summed up in parallel for up to `_ESTIMATE_TIMEOUT` seconds. Trees not done by
+            then are assumed to be as large as the largest one done, they end up in shards of their own.
+
+            :return: Dict[str, int], KiB used below each shard path on the source, empty if the estimate failed
+            """
+            list_cmd = 'find / {} -mindepth 1 -maxdepth 1 -type d 2>/dev/null'.format(' '.join(RSYNC_SPLIT_DIRS))
+            _, output = self._ssh_sudo_out(list_cmd, machine_context=self.SOURCE)
+            paths = [path for path in output.decode('utf-8', 'replace').splitlines()
+                     if path not in RSYNC_SPLIT_DIRS and _SHARD_PATH_RE.match(path)
+                     and not matches_any([path, path + '/*'], self.excluded_paths)]
+            if not paths:
+                return {}
+            # du fails on files vanishing meanwhile, the sizes it did get are still good for balancing
+            du_cmd = 'for path in {}; do timeout {} du -x -s -k "$path" & done; wait'.format(' '.join(paths),
+                                                                                           _ESTIMATE_TIMEOUT)
+            _, output = self._ssh_sudo_out(du_cmd, machine_context=self.SOURCE)
+            sizes = {}
+            for line in output.decode('utf-8', 'replace').splitlines():
+                size, _, path = line.partition('\t')
+                if path in paths and size.isdigit():
+                    sizes[path] = int(size)
+            if not sizes:
+                return {}
+            largest = max(sizes.values())
+            for path in paths:
+                sizes.setdefault(path, largest)
+            return sizes
+
+        def _rsync_sharded(self, start, shards, options='', step=None, journaled=True):
+            """
+            Copy each of `shards` by a parallel rsync, then everything else by a final one
+
+            The final pass starts once the shards are done, so no more than `len(shards)` rsync processes
+            run at a time, and the attributes of the directories above the shards it brings in line are not
+            changed by the shards afterwards.
+
+            :param start: callable, `start(paths, options)` starts rsync copying `paths` (the whole tree
+                          if None) with additional `options` and returns the child process, its
+                          standard output piped
+            :param shards: List[List[str]], paths copied by each of the parallel rsync processes
+            :param options: str, additional options of all rsync processes
+            :param step: str, step of the migration the completed shards are journaled under, shards
+                         journaled as completed before (the final pass has the index `len(shards)`) are skipped
+            :param journaled: bool, whether the shards completed now are journaled under `step`, pre-copy
+                              passes only skip the shards the final pass completed before
+            :return: Tuple[int, Dict[str, int]], merged exit status and summed up statistics
+            """
+            completed = set()
+            if step is not None and self.journal is not None:
+                completed.update(self.journal['completed'].get(step, []))
+            options += ' --stats'
+            children = [(index, start(paths, '-R' + options)) for index, paths in enumerate(shards)
+                        if index not in completed]
+            # Only the statistics are written to standard output, they fit into the pipe buffer
+            outputs, statuses = [], []
+
+            def _wait(index, child):
+                outputs.append(child.communicate()[0])
+                statuses.append(child.returncode)
+                self._shard_completed(step if journaled else None, index, child.returncode)
+
+            for index, child in children:
+                _wait(index, child)
+            if len(shards) not in completed:
+                excluded = ' '.join('--exclude=' + path for paths in shards for path in paths)
+                _wait(len(shards), start(None, excluded + options))
+            stats = {'files': 0, 'bytes': 0}
+            for output in outputs:
+                for name, value in _parse_rsync_stats(output).items():
+                    stats[name] += value
+            return _merge_rsync_status(statuses), stats
+
         def copy(self):
             container_name = self.get_target_container_name()
             container_dir = self._get_container_dir()
 
-            def _rsync():
-                rsync_dir = container_dir
-
-                try:
-                    os.makedirs(rsync_dir)
-                except OSError as exc:
-                    if exc.errno != errno.EEXIST:  # raise exception if it's different than FileExists
-                        raise
-
+            def _rsync_options():
+                options = '-aAX -r'
+                for excluded in self.excluded_paths:
+                    options += ' --exclude=' + excluded
+                return options
+
+            def _rsync_sources(paths):
+                return ' '.join('{}:{}'.format(self.source_addr, path) for path in paths or ['/'])
+
+            def _rsync_pull_on_target(paths, options):
+                # The target authenticates to the source with the agent forwarded by this session,
+                # identity files of this machine don't exist over there
+                source_cfg = [opt for opt in self.source_cfg if 'IdentityFile=' not in opt]
+                pull_cmd = 'rsync --rsync-path="sudo rsync" {} {} -e "ssh {}" {} {}/'.format(
+                    _rsync_options(), options, ' '.join(source_cfg), _rsync_sources(paths), container_dir)
+                return self._ssh_make_child('sudo SSH_AUTH_SOCK="$SSH_AUTH_SOCK" bash -c \'{}\''.format(pull_cmd),
+                                            forward_agent=True, stdout=PIPE)
+
+            def _rsync_pull(paths, options):
+                source_cmd = 'sudo rsync --rsync-path="sudo rsync" {} {} -e "ssh {} {}" {} {}'.format(
+                    _rsync_options(), options, self._SSH_CONTROL_PATH, ' '.join(self.source_cfg),
+                    _rsync_sources(paths), container_dir
+                )
+                return Popen(shlex.split(source_cmd), stdout=PIPE)
+
+            def _rsync_push(paths, options):
+                # The /./ marks where the paths relative to the staging directory start for -R
+                sources = [container_dir + '/.' + path for path in paths] if paths else [container_dir + '/']
+                target_cmd = 'sudo rsync -aAX --rsync-path="sudo rsync" -r {} {} -e "ssh {} {}" {}:{}'.format(
+                    options, ' '.join(sources), self._SSH_CONTROL_PATH, ' '.join(self.target_cfg),
+                    self.target_addr, container_dir
+                )
+                return Popen(shlex.split(target_cmd), stdout=PIPE)
+
+            def _report(label, stats):
+                print('! {}: {} files, {} bytes transferred'.format(label, stats['files'], stats['bytes']))
+
+            def _rsync_linked(start):
+                # Only the read-mostly directories are linked, a file modified in place would change in
+                # every container sharing it. The copy of the shards then finds them up to date.
+                link_dest = self._link_dest_options()
+                if not link_dest:
+                    return
+                child = start(['/' + directory for directory in DEDUP_DIRS], '-R --stats ' + link_dest)
+                output = child.communicate()[0]
+                # Linking is an optimization only, whatever it missed is transferred by the full copy
+                if child.returncode not in (0,) + _RSYNC_PARTIAL:
+                    print('! copy linked to earlier containers failed with exit status {}, copying in full'.format(
+                        child.returncode))
+                    return
+                _report('copy linked to earlier containers', _parse_rsync_stats(output))
+
+            def _rsync_from_source(pull, shards, linked):
                 self._open_permanent_ssh_conn(self.SOURCE)
+                frozen_at = None
                 try:
+                    if shards is None:
+                        shards = []
+                        if self.rsync_jobs > 1:
+                            shards = balanced_partition(self._estimate_shards(), self.rsync_jobs)
+                        self.checkpoint(shards=shards)
+                    if shards:
+                        print('! copying the filesystem by {} parallel rsync processes'.format(len(shards)))
+                    if linked:
+                        _rsync_linked(pull)
+
+                    # Files deleted on the live source meanwhile are deleted by the passes after the first
+                    options, transferred = '', None
+                    for copy_pass in range(1, self.pre_copy_passes + 1):
+                        ret_code, stats = self._rsync_sharded(pull, shards, options, step=self.PHASE_PULL,
+                                                              journaled=False)
+                        _report('pre-copy pass {}'.format(copy_pass), stats)
+                        if ret_code not in (0,) + _RSYNC_PARTIAL:
+                            print('! pre-copy pass {} failed with exit status {}'.format(copy_pass, ret_code))
+                            break
+                        if stats['bytes'] <= self.pre_copy_threshold:
+                            break
+                        if transferred is not None and stats['bytes'] >= transferred:
+                            print('! changes on the source do not converge, stopping pre-copy')
+                            break
+                        options, transferred = ' --delete', stats['bytes']
+                    if self.pre_copy_passes:
+                        options = ' --delete'
+
                     sync_cmd = 'sync'
                     if self.freeze:
                         sync_cmd += ' && fsfreeze -f /'
@@ -394,27 +813,54 @@ def main():
                     ret_code = self._ssh_sudo(sync_cmd, machine_context=self.SOURCE, reuse_ssh_conn=True)
                     if ret_code != 0:
                         sys.exit(ret_code)
+                    frozen_at = time.time()
 
-                    source_cmd = 'sudo rsync --rsync-path="sudo rsync" -aAX -r'
-                    for excluded in self.excluded_paths:
-                        source_cmd += ' --exclude=' + excluded
-                    source_cmd += ' -e "ssh {} {}" {}:/ {}'.format(
-                        self._SSH_CONTROL_PATH, ' '.join(self.source_cfg), self.source_addr, rsync_dir
-                    )
-
-                    Popen(shlex.split(source_cmd)).wait()
+                    ret_code, stats = self._rsync_sharded(pull, shards, options, step=self.PHASE_PULL)
+                    _report('final pass' if self.pre_copy_passes else 'copy', stats)
                 finally:
                     if self.freeze:
                         self._ssh_sudo('fsfreeze -u /', machine_context=self.SOURCE, reuse_ssh_conn=True)
+                    if self.freeze and frozen_at is not None:
+                        print('! source filesystem was frozen for {:.1f} seconds'.format(time.time() - frozen_at))
                     self._close_permanent_ssh_conn(self.SOURCE)
+                return ret_code, shards
 
-                # if it's localhost this should not be executed
-                # and it would be useful to check if source and target are in the same network
-                # if yes then source -> rsync -> custom target
-                if self.target_addr not in ['127.0.0.1', 'localhost']:
-                    target_cmd = 'sudo rsync -aAX --rsync-path="sudo rsync" -r {0}/ -e "ssh {1}" {2}:{0}' \
-                                 .format(rsync_dir, ' '.join(self.target_cfg), self.target_addr)
-                    Popen(shlex.split(target_cmd)).wait()
+            def _rsync():
+                rsync_dir = container_dir
+                direct = self.direct_copy and not self._target_is_local()
+
+                if not direct:
+                    try:
+                        os.makedirs(rsync_dir)
+                    except OSError as exc:
+                        if exc.errno != errno.EEXIST:  # raise exception if it's different than FileExists
+                            raise
+
+                journal = self.journal or {}
+                shards = journal.get('shards')
+                ret_code = 0
+                if journal.get('phase', self.PHASE_PULL) == self.PHASE_PULL:
+                    # The container migrated before can only be linked from when the target receives the files
+                    ret_code, shards = _rsync_from_source(_rsync_pull_on_target if direct else _rsync_pull, shards,
+                                                          self.dedup and (direct or self._target_is_local()))
+                    if ret_code not in (0,) + _RSYNC_PARTIAL:
+                        print('! rsync finished with exit status {}'.format(ret_code))
+                        return ret_code
+                    self.checkpoint(phase=self.PHASE_PUSH)
+
+                # With --direct-copy the data is already on a remote target, otherwise it was staged
+                # here and still has to be pushed to it
+                if not direct and not self._target_is_local():
+                    if self.dedup:
+                        _rsync_linked(_rsync_push)
+                    push_code, stats = self._rsync_sharded(_rsync_push, shards, step=self.PHASE_PUSH)
+                    _report('push to target', stats)
+                    ret_code = _merge_rsync_status([ret_code, push_code])
+                if ret_code != 0:
+                    print('! rsync finished with exit status {}'.format(ret_code))
+                if self.dedup and ret_code in (0,) + _RSYNC_PARTIAL:
+                    self.dedup_container()
+                return ret_code
 
             def _virt_tar_out():
                 try:
@@ -496,13 +942,13 @@ def main():
 
                 if use_default_port_map:
                     print_info('! Scanning source ports')
-                    src_ports = _port_scan(self.source_addr, shallow=True)
+                    src_ports = self._scan_ports(self.source, self.source_addr, True, print_info)
                 else:
                     src_ports = PortList()
 
 
                 print_info('! Scanning target ports')
-                dst_ports = _port_scan(self.target_addr, shallow=True)
+                dst_ports = self._scan_ports(self.target, self.target_addr, False, print_info)
 
                 tcp_mapping = self._port_remap(src_ports, dst_ports, user_mapped_ports, user_excluded_ports)["tcp"]
 
@@ -514,6 +960,21 @@ def main():
                 return -1, None
             return 0, tcp_mapping
 
+        @staticmethod
+        def _scan_ports(machine, addr, external, print_info=print):
+            # Machines reached over SSH list their listening sockets, which is quicker than a scan and
+            # isn't fooled by firewalls. Ports bound to loopback only are not reachable by clients
+            # of the source, the target has to keep them free nevertheless.
+            if isinstance(machine, SSHMachine):
+                try:
+                    port_list = PortList()
+                    for port in machine.helper.listening_ports(external):
+                        port_list.set_port(port_list.PROTO_TCP, port, {})
+                    return port_list
+                except (InspectionError, DriverError, SSHError, EnvironmentError) as e:
+                    print_info('! listing ports of {} failed, scanning instead: {}'.format(addr, e))
+            return _port_scan(addr, shallow=True)
+
         @staticmethod
         def _port_remap(source_ports, target_ports, user_mapped_ports = None, user_excluded_ports = None):
             """
@@ -620,9 +1081,17 @@ def main():
                 return rc
             return self._ssh_sudo(
                 'docker rm -fv {0} 2>/dev/null 1>/dev/null; '
-                'rm -rf {1}/{0}'.format(container_name, storage_dir)
+                'rm -rf {1}/{0} "{2}"; {3}'.format(container_name, storage_dir, self._journal_path(container_name),
+                                                  COLLECT_GARBAGE_COMMAND)
             )
 
+        def remove_container(self):
+            """
+            Remove the container of the migration on the target if there is one, leaving its directory alone
+            """
+            return self._ssh_sudo('docker rm -f {} 2>/dev/null 1>/dev/null; true'.format(
+                self.get_target_container_name()))
+
         def start_container(self, img, init, forwarded_ports=None, extra_arg=None, pre_cmd=None):
             if forwarded_ports is None:
                 port_map_result, forwarded_ports = self.map_ports()
@@ -637,7 +1106,9 @@ def main():
             command += 'docker run -tid -v /sys/fs/cgroup:/sys/fs/cgroup:ro'
             good_mounts = ['bin', 'etc', 'home', 'lib', 'lib64', 'media', 'opt', 'root', 'sbin', 'srv', 'usr', 'var']
             for mount in good_mounts:
-                command += ' -v {d}/{m}:/{m}:Z'.format(d=container_dir, m=mount)
+                # Files shared with other containers can't get a label private to this one
+                label = 'z' if self.dedup and mount in DEDUP_DIRS else 'Z'
+                command += ' -v {d}/{m}:/{m}:{l}'.format(d=container_dir, m=mount, l=label)
             for host_port, container_port in forwarded_ports:
                 if host_port is None:
                     command += ' -p {:d}'.format(container_port)  # docker will select random port for host
@@ -654,6 +1125,13 @@ def main():
 
         def post_configure_upstart(self):
             container_dir = self._get_container_dir()
+            if not self._target_is_local():
+                # The container filesystem only exists on the target
+                return self._ssh_sudo(
+                    'cd {}/etc && for link in rc[0-6].d/*; do '
+                    'case $(basename "$(readlink "$link")") in {}) rm -f "$link";; esac; done; '
+                    'echo "exit 0" > init/rcS-emergency.conf'.format(container_dir,
+                                                                     '|'.join(UPSTART_SERVICE_BLACKLIST)))
             for level in range(0, 7):
                 p = os.path.join(container_dir, 'etc', 'rc{}.d'.format(level))
                 for entry in os.listdir(p):
@@ -666,12 +1144,64 @@ def main():
 
     argcomplete.autocomplete(ap)
     parsed = ap.parse_args()
+    if parsed.metrics:
+        INSTRUMENTATION.enable()
+        atexit.register(_write_metrics, parsed.metrics)
     if parsed.action == 'list-machines':
+        package_cache = None if parsed.no_package_cache else PackageCache()
+        if parsed.watch:
+            if parsed.ip:
+                print("--watch can't be combined with --ip")
+                sys.exit(-1)
+            lmp = _make_machine_provider(parsed, LiveLibvirtMachineProvider, shallow_scan=parsed.shallow,
+                                         jobs=parsed.jobs, inspect_guests=not parsed.shallow,
+                                         package_cache=package_cache, timeout=parsed.timeout)
+            generation = None
+            try:
+                while True:
+                    current = lmp.wait_for_change(generation, timeout=1)
+                    if current != generation:
+                        generation = current
+                        print(dumps({'machines': [m._to_dict() for m in lmp.get_machines(parsed.pattern)]}))
+                        sys.stdout.flush()
+            except KeyboardInterrupt:
+                lmp.close()
+            sys.exit(0)
         if not parsed.ip:
-            lmp = LibvirtMachineProvider(parsed.shallow)
-            machines = lmp.get_machines()
+            lmp = _make_machine_provider(parsed, shallow_scan=parsed.shallow, jobs=parsed.jobs,
+                                         inspect_guests=not parsed.shallow, package_cache=package_cache,
+                                         timeout=parsed.timeout)
+            machines = lmp.get_machines(parsed.pattern)
         else:
-            machines = [_inspect_machine(m, shallow=parsed.shallow, user=parsed.user or 'root') for m in parsed.ip]
+            try:
+                addresses = list(expand_addresses(parsed.ip, max_network_hosts=parsed.max_network_hosts))
+            except ValueError as e:
+                sys.stderr.write('{}\n'.format(e))
+                sys.exit(-1)
+            inspected = {}
+            local = [address for address in addresses if address in ('localhost', '127.0.0.1')]
+            # The probes on all remote machines are served by a single loop, only connecting takes a thread each
+            results = itertools.chain(
+                ((address, _inspect_machine(address, shallow=parsed.shallow, package_cache=package_cache), None)
+                 for address in local),
+                inspect_hosts([address for address in addresses if address not in local], user=parsed.user or 'root',
+                              shallow=parsed.shallow, package_cache=package_cache, jobs=parsed.jobs,
+                              timeout=parsed.timeout)
+            )
+            for address, machine, error in results:
+                if error is not None:
+                    sys.stderr.write('Inspection of {} failed: {}\n'.format(address, error))
+                    continue
+                # Addresses can't be matched against hostnames before the machines are inspected
+                if not machine or not matches_any([address, machine.hostname], parsed.pattern):
+                    continue
+                if parsed.stream:
+                    print(dumps(machine._to_dict()))
+                    sys.stdout.flush()
+                inspected[address] = machine
+            if parsed.stream:
+                sys.exit(0)
+            machines = [inspected[address] for address in addresses if address in inspected]
         print(dumps({'machines': [m._to_dict() for m in machines if m]}, indent=3))
 
     elif parsed.action == 'migrate-machine':
@@ -685,23 +1215,39 @@ def main():
 
         print_migrate_info('! looking up "{}" as source and "{}" as target'.format(source, target))
 
-        lmp = LibvirtMachineProvider()
-        machines = lmp.get_machines()
+        # Only the OS release of the machines is needed, so skip the package inspection
+        lmp = _make_machine_provider(parsed, shallow_scan=True)
         source_user = parsed.source_user or 'root'
         target_user = parsed.target_user or 'root'
 
-        machine_src = _find_machine(machines, source, user=source_user)
+        machine_src = _find_machine(lmp, source, user=source_user)
 
         if not machine_src:
             print("Source machine is not ready: " + source)
             sys.exit(-1)
 
-        machine_dst = _find_machine(machines, target, user=target_user)
+        machine_dst = _find_machine(lmp, target, user=target_user)
 
         if not machine_dst:
             print("Target machine is not ready: " + target)
             sys.exit(-1)
 
+        if parsed.direct_copy and (parsed.source_ask_pass or not parsed.use_rsync):
+            print("--direct-copy requires the rsync backend and key based authentication to the source")
+            sys.exit(-1)
+
+        if parsed.pre_copy and not parsed.use_rsync:
+            print("--pre-copy requires the rsync backend")
+            sys.exit(-1)
+
+        if parsed.dedup and not parsed.use_rsync:
+            print("--dedup requires the rsync backend")
+            sys.exit(-1)
+
+        if parsed.rsync_jobs < 1:
+            print("--rsync-jobs has to be at least 1")
+            sys.exit(-1)
+
         print_migrate_info('! configuring SSH keys')
 
         mc = MigrationContext(
@@ -712,11 +1258,17 @@ def main():
             _set_ssh_config(parsed.source_user, parsed.source_identity, parsed.source_ask_pass),
             parsed.use_rsync,
             parsed.container_name,
-            parsed.excluded_paths
+            parsed.excluded_paths,
+            parsed.direct_copy,
+            parsed.rsync_jobs
         )
 
         mc.freeze_fs(parsed.freeze_fs)
+        mc.deduplicate(parsed.dedup)
+        if parsed.pre_copy:
+            mc.pre_copy(parsed.pre_copy_passes, parsed.pre_copy_threshold * 1024 * 1024)
 
+        journal = None
         if not parsed.print_port_map:
             # If we're doing an actual migration, check we have access to the
             # target, and the desired container name is available
@@ -726,7 +1278,28 @@ def main():
                 sys.exit(check_result)
 
             container_name = mc.get_target_container_name()
-            if container_name in target_status['containers']:
+            if parsed.resume:
+                journal = mc.load_journal()
+                if journal is None:
+                    print_migrate_info('! no interrupted migration to {} found, starting over'.format(container_name))
+                elif journal.get('source') != mc.source_addr:
+                    print("! Container {} was migrated from {}".format(container_name, journal.get('source')))
+                    sys.exit(-10)
+                elif journal['phase'] == mc.PHASE_DONE:
+                    print_migrate_info('! migration to {} already finished'.format(container_name))
+                    sys.exit(0)
+                else:
+                    print_migrate_info('! resuming migration to {} at phase {}'.format(container_name,
+                                                                                     journal['phase']))
+                    # Files linked to the object store before the interruption are shared with other
+                    # containers, which decides the SELinux labels of the mounts
+                    if journal.get('dedup') and not mc.dedup:
+                        print_migrate_info('! files were deduplicated before the interruption, continuing with --dedup')
+                        mc.deduplicate()
+                    journal['dedup'] = mc.dedup
+
+            # The container directory of the interrupted migration is being resumed, not destroyed
+            if container_name in target_status['containers'] and journal is None:
                 if not parsed.force_create:
                     print("! Container name {} is not available".format(container_name))
                     sys.exit(-10)
@@ -736,15 +1309,19 @@ def main():
                     print("! Destroying pre-existing container failed")
                     sys.exit(destroy_result)
 
-        port_map_result, tcp_mapping = mc.map_ports(
-            use_default_port_map = not parsed.ignore_default_port_map,
-            forwarded_tcp_ports = parsed.forwarded_tcp_ports,
-            excluded_tcp_ports = parsed.excluded_tcp_ports,
-            print_info = print_migrate_info
-        )
-        if port_map_result != 0:
-            print("! Mapping source ports to target ports failed")
-            sys.exit(port_map_result)
+        if journal is not None and journal.get('port_map') is not None:
+            # Ports chosen before the interruption may be taken meanwhile, but the mapping has to stay the same
+            tcp_mapping = [tuple(pmap) for pmap in journal['port_map']]
+        else:
+            port_map_result, tcp_mapping = mc.map_ports(
+                use_default_port_map = not parsed.ignore_default_port_map,
+                forwarded_tcp_ports = parsed.forwarded_tcp_ports,
+                excluded_tcp_ports = parsed.excluded_tcp_ports,
+                print_info = print_migrate_info
+            )
+            if port_map_result != 0:
+                print("! Mapping source ports to target ports failed")
+                sys.exit(port_map_result)
 
         if parsed.print_port_map:
             # If we're only printing the port map, skip the full migration
@@ -761,8 +1338,19 @@ def main():
 
         print_migrate_info("! +-------------+-------------+")
 
-        print_migrate_info('! copying over')
-        mc.copy()
+        mc.start_journal(journal)
+        mc.checkpoint(port_map=tcp_mapping)
+
+        if mc.journal['phase'] in (mc.PHASE_PULL, mc.PHASE_PUSH):
+            print_migrate_info('! copying over')
+            copy_result = mc.copy()
+            if copy_result not in (0,) + _RSYNC_PARTIAL:
+                print("! Copying the filesystem failed, continue with --resume")
+                sys.exit(copy_result)
+            mc.checkpoint(phase=mc.PHASE_PROVISION)
+        elif journal is not None:
+            # The container may have been created before the interruption, its directory is kept
+            mc.remove_container()
         print_migrate_info('! provisioning ...')
 
         # if el7 then use systemd
@@ -801,16 +1389,17 @@ def main():
                                         tcp_mapping,
                                         vol_command,
                                         pre_command)
+        if result == 0:
+            mc.checkpoint(phase=mc.PHASE_DONE)
         print_migrate_info('! done')
         sys.exit(result)
 
     elif parsed.action == 'check-target':
         target = parsed.target
 
-        lmp = LibvirtMachineProvider()
-        machines = lmp.get_machines()
+        lmp = _make_machine_provider(parsed, shallow_scan=True)
 
-        machine_dst = _find_machine(machines, target)
+        machine_dst = _find_machine(lmp, target)
         if not machine_dst:
             print("Target machine is not ready: " + target)
             sys.exit(-1)
@@ -835,10 +1424,9 @@ def main():
     elif parsed.action == 'destroy-container':
         target = parsed.target
 
-        lmp = LibvirtMachineProvider()
-        machines = lmp.get_machines()
+        lmp = _make_machine_provider(parsed, shallow_scan=True)
 
-        machine_dst = _find_machine(machines, target)
+        machine_dst = _find_machine(lmp, target)
         if not machine_dst:
             print("Target machine is not ready: " + target)
             sys.exit(-1)
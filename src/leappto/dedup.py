@@ -0,0 +1,149 @@
+import json
+
+from leappto.providers.ssh import _python_command
+
+
+OBJECT_STORE_DIR = '/var/lib/leapp/objects/'
+# Directories of a container holding files installed by packages, which are replaced rather than
+# modified in place, so sharing them between containers by hard links is safe
+DEDUP_DIRS = ('usr', 'lib', 'lib64', 'bin', 'sbin')
+
+# Runs on the target with the Python version found there (2.6 and newer). Each regular file below
+# the read-mostly directories of the container is hashed and becomes a hard link of the object with
+# the same content and metadata in the store, the first file with new content becomes the object.
+_DEDUP_SCRIPT = """
+import errno, hashlib, json, os, stat, sys
+
+if hasattr(os, 'listxattr'):
+    def xattrs(path):
+        return [(name.encode('utf-8', 'surrogateescape'), os.getxattr(path, name, follow_symlinks=False))
+                for name in os.listxattr(path, follow_symlinks=False)]
+else:
+    # Python 2 has no extended attribute functions
+    import ctypes, ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    def xattr_read(function, *args):
+        size = function(*(args + (None, 0)))
+        if size >= 0:
+            buf = ctypes.create_string_buffer(size)
+            size = function(*(args + (buf, size)))
+        if size < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return buf.raw[:size]
+
+    def xattrs(path):
+        names = [name for name in xattr_read(libc.llistxattr, path).split(b'\\0') if name]
+        return [(name, xattr_read(libc.lgetxattr, path, name)) for name in names]
+
+def attributes_key(path):
+    # rsync -AX copies the ACLs, stored as extended attributes, and the extended attributes. The SELinux
+    # label is left out, it is relabeled for the container on its start anyway.
+    try:
+        attributes = sorted(xattrs(path))
+    except (IOError, OSError):
+        if sys.exc_info()[1].errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+        attributes = []
+    attributes = [(name, value) for name, value in attributes if name != b'security.selinux']
+    if not attributes:
+        return ''
+    digest = hashlib.sha256()
+    for name, value in attributes:
+        digest.update(name + b'\\0' + str(len(value)).encode('ascii') + b'\\0' + value)
+    return '-' + digest.hexdigest()
+
+def object_key(path, st):
+    digest = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(1048576)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        f.close()
+    # Hard links share the inode and with it all metadata, so it is a part of the key
+    return '%s-%o-%d-%d-%d%s' % (digest.hexdigest(), stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid,
+                                 int(st.st_mtime), attributes_key(path))
+
+def link_object(path, st, store):
+    key = object_key(path, st)
+    directory = os.path.join(store, key[:2])
+    obj = os.path.join(directory, key)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    try:
+        os.link(path, obj)
+        return False
+    except OSError:
+        if sys.exc_info()[1].errno != errno.EEXIST:
+            raise
+    tmp = path + '.leapp-dedup'
+    os.link(obj, tmp)
+    os.rename(tmp, path)
+    return True
+
+def dedup(root, store):
+    stats = {'files': 0, 'linked': 0, 'bytes': 0, 'errors': 0}
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    device = os.stat(store).st_dev
+    for top in DIRS:
+        top = os.path.join(root, top)
+        if os.path.islink(top) or not os.path.isdir(top):
+            continue
+        for dirpath, _, filenames in os.walk(top):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode) or not st.st_size or st.st_dev != device:
+                    continue
+                stats['files'] += 1
+                # Linked already, by an earlier run or by rsync --link-dest
+                if st.st_nlink > 1:
+                    continue
+                try:
+                    if link_object(path, st, store):
+                        stats['linked'] += 1
+                        stats['bytes'] += st.st_size
+                except (IOError, OSError):
+                    stats['errors'] += 1
+    sys.stdout.write(json.dumps(stats) + '\\n')
+
+dedup(ROOT, STORE)
+"""
+
+# Removes objects no container links to anymore
+COLLECT_GARBAGE_COMMAND = 'find {} -type f -links 1 -delete 2>/dev/null'.format(OBJECT_STORE_DIR)
+
+
+def dedup_command(container_dir):
+    """
+    Build command hard linking the read-mostly files of `container_dir` to the object store
+
+    :param container_dir: str, path of the container on the target
+    :return: str, command line, it prints the statistics as JSON
+    """
+    return _python_command(_DEDUP_SCRIPT, ROOT=container_dir, STORE=OBJECT_STORE_DIR, DIRS=DEDUP_DIRS)
+
+
+def parse_dedup_output(output):
+    """
+    :param output: bytes, output of the command built by `dedup_command`
+    :return: Dict[str, int], number of `files` examined, `linked` to objects, `bytes` saved and `errors`,
+             None if the output is not understood
+    """
+    lines = output.decode('utf-8', 'replace').strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return None
@@ -1,14 +1,340 @@
+import errno
+import os
+import select
 import shlex
 import subprocess
+import time
+
+from leappto.driver.instrumentation import INSTRUMENTATION, CommandRecorder, command_size
+
+
+# Interval in which executions without file descriptors to wait for are polled
+_STEP_INTERVAL = 0.1
+
+
+class DriverError(Exception):
+    pass
+
+
+class CommandTimeout(DriverError):
+    pass
+
+
+class OutputLimitExceeded(DriverError):
+    pass
+
+
+class CommandFailed(DriverError):
+    def __init__(self, cmd, returncode, stderr):
+        super(CommandFailed, self).__init__('Command {} failed with exit status {}: {}'.format(
+            _shorten(cmd), returncode, stderr.decode('utf-8', 'replace').strip()))
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+def _shorten(cmd, limit=60):
+    return repr(cmd if len(cmd) <= limit else cmd[:limit] + '...')
+
+
+def _poll(watched, timeout):
+    """
+    Wait up to `timeout` seconds for any of the `watched` descriptors and let their executions handle them
+
+    :param watched: Dict[int, Execution], executions by file descriptor
+    :param timeout: float, seconds to wait, None waits forever
+    :return: bool, whether anything was handled
+    """
+    # poll() has no limit on descriptor numbers, unlike select()
+    poller = select.poll()
+    for fd in watched:
+        poller.register(fd, select.POLLIN)
+    try:
+        events = poller.poll(None if timeout is None else max(timeout, 0) * 1000)
+    except select.error as e:
+        if e.args[0] != errno.EINTR:
+            raise
+        events = []
+    for fd, _ in events:
+        if not watched[fd].finished:
+            watched[fd].handle(fd)
+    return bool(events)
+
+
+class Execution(object):
+    """
+    Command started by `Driver.exec_async`
+
+    Output is collected by `run_executions` without blocking, so any number of commands on
+    any number of machines are served by a single thread. Unless `on_output` is given, the
+    output is accumulated and available as `stdout` and `stderr` once the command finished.
+
+    :ivar returncode: int, exit status, None until finished or when killed on timeout
+    :ivar timed_out: bool, the command was killed because it did not finish in time
+
+    Finished executions are recorded by `INSTRUMENTATION` under `host`.
+    """
+
+    STDOUT = 'stdout'
+    STDERR = 'stderr'
+
+    _READ_SIZE = 65536
+
+    def __init__(self, cmd, on_output=None, host=None):
+        """
+        :param cmd: str, the command
+        :param on_output: callable, called as `on_output(execution, stream, data)` for each chunk of output
+        :param host: str, machine the command runs on
+        """
+        self.cmd = cmd
+        self.host = host
+        self.returncode = None
+        self.finished = False
+        self.timed_out = False
+        self._on_output = on_output
+        self._output = {self.STDOUT: [], self.STDERR: []}
+        self._started = time.time()
+        self._first_byte = None
+        self._received = 0
+
+    @property
+    def stdout(self):
+        return b''.join(self._output[self.STDOUT])
+
+    @property
+    def stderr(self):
+        return b''.join(self._output[self.STDERR])
+
+    def _emit(self, stream, data):
+        if self._first_byte is None:
+            self._first_byte = time.time() - self._started
+        self._received += len(data)
+        if self._on_output is not None:
+            self._on_output(self, stream, data)
+        else:
+            self._output[stream].append(data)
+
+    def _finish(self, returncode):
+        self.returncode = returncode
+        self.finished = True
+        # Standard input of executions is closed right away, only the command line is sent
+        INSTRUMENTATION.record_command(self.host, self.cmd, time.time() - self._started, self._first_byte,
+                                       self._received, command_size(self.cmd), returncode)
+
+    def fds(self):
+        """
+        :return: List[int], file descriptors becoming readable when the execution has something to handle
+        """
+        raise NotImplementedError()
+
+    def handle(self, fd):
+        """
+        Consume what is available on `fd` without blocking, finish the execution at the end of output
+        """
+        raise NotImplementedError()
+
+    def step(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for output or the end of the command and handle it
+
+        :param timeout: float, seconds to wait, None waits until there is something to handle
+        """
+        _poll(dict((fd, self) for fd in self.fds()), timeout)
+
+    def kill(self):
+        """
+        Stop the command and finish the execution
+        """
+        raise NotImplementedError()
+
+
+class ProcessExecution(Execution):
+    """
+    Execution of a local process, e.g. `ssh` running the command remotely
+    """
+
+    def __init__(self, cmd, args, on_output=None, host='localhost'):
+        super(ProcessExecution, self).__init__(cmd, on_output, host)
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._process.stdin.close()
+        self._streams = {self._process.stdout.fileno(): (self.STDOUT, self._process.stdout),
+                         self._process.stderr.fileno(): (self.STDERR, self._process.stderr)}
+
+    def fds(self):
+        return list(self._streams)
+
+    def handle(self, fd):
+        stream, f = self._streams[fd]
+        data = os.read(fd, self._READ_SIZE)
+        if data:
+            self._emit(stream, data)
+            return
+        f.close()
+        del self._streams[fd]
+        if not self._streams:
+            self._finish(self._process.wait())
+
+    def kill(self):
+        try:
+            self._process.kill()
+        except OSError:
+            pass
+        self._process.wait()
+        for _, f in self._streams.values():
+            f.close()
+        self._streams = {}
+        self._finish(None)
+
+
+def run_executions(executions, timeout=None, jobs=None):
+    """
+    Wait for `executions` in the calling thread, yielding each of them once it finished
+
+    Executions are taken from `executions` only while fewer than `jobs` are running, so an
+    iterator starting them as they are taken keeps no more than `jobs` commands running.
+
+    :param executions: Iterable[Execution], executions, started by the time they are taken
+    :param timeout: float, seconds after its start an execution still running is killed (and yielded)
+    :param jobs: int, maximum number of executions running at a time, unlimited if None
+    :return: Iterator[Execution]
+    """
+    executions = iter(executions)
+    pending = []
+    while True:
+        while jobs is None or len(pending) < jobs:
+            execution = next(executions, None)
+            if execution is None:
+                break
+            pending.append(execution)
+        if not pending:
+            return
+        watched, stepped = {}, []
+        for execution in pending:
+            fds = execution.fds()
+            if not fds:
+                stepped.append(execution)
+            for fd in fds:
+                watched[fd] = execution
+        wait = None
+        if timeout is not None:
+            wait = min(execution._started for execution in pending) + timeout - time.time()
+        if stepped:
+            wait = _STEP_INTERVAL if wait is None else min(wait, _STEP_INTERVAL)
+        _poll(watched, wait)
+        for execution in stepped:
+            execution.step(0)
+        if timeout is not None:
+            now = time.time()
+            for execution in pending:
+                if not execution.finished and now - execution._started >= timeout:
+                    execution.kill()
+                    execution.timed_out = True
+        remaining = []
+        for execution in pending:
+            if execution.finished:
+                yield execution
+            else:
+                remaining.append(execution)
+        pending = remaining
 
 
 class Driver(object):
+    _ERROR_TAIL = 4096
+
     def __init__(self):
         pass
 
     def exec_command(self, cmd):
         raise NotImplementedError()
 
+    def close(self):
+        """
+        Release what the driver holds on to, e.g. its SSH connection, the driver is not usable afterwards
+        """
+        pass
+
+    def exec_async(self, cmd, on_output=None):
+        """
+        Start `cmd` without waiting for it, wait for the result with `run_executions`
+
+        :param cmd: str, the command
+        :param on_output: callable, called as `on_output(execution, stream, data)` for each chunk of output
+        :return: Execution
+        """
+        raise NotImplementedError()
+
+    def stream(self, cmd, timeout=None, max_bytes=None, check=True):
+        """
+        Run `cmd`, yielding chunks of its output as they arrive
+
+        The command is killed when it does not finish within `timeout` seconds, produces more
+        than `max_bytes` bytes of output or the iteration is abandoned.
+
+        :param cmd: str, the command
+        :param timeout: float, deadline of the command in seconds
+        :param max_bytes: int, maximum number of bytes of output
+        :param check: bool, raise `CommandFailed` if the command exits with non-zero status
+        :return: Iterator[Tuple[str, bytes]], stream (`Execution.STDOUT` or `Execution.STDERR`) and data
+        :raises: CommandTimeout, OutputLimitExceeded, CommandFailed
+        """
+        chunks = []
+        execution = self.exec_async(cmd, on_output=lambda _, stream, data: chunks.append((stream, data)))
+        deadline = None if timeout is None else time.time() + timeout
+        received = 0
+        stderr_tail = b''
+        try:
+            while True:
+                if not execution.finished:
+                    if deadline is not None and time.time() >= deadline:
+                        raise CommandTimeout('Command {} did not finish in {} seconds'.format(_shorten(cmd), timeout))
+                    execution.step(None if deadline is None else deadline - time.time())
+                for stream, data in chunks:
+                    received += len(data)
+                    if max_bytes is not None and received > max_bytes:
+                        raise OutputLimitExceeded('Command {} produced more than {} bytes of output'.format(
+                            _shorten(cmd), max_bytes))
+                    if stream == Execution.STDERR:
+                        stderr_tail = (stderr_tail + data)[-self._ERROR_TAIL:]
+                    yield stream, data
+                del chunks[:]
+                if execution.finished:
+                    break
+        finally:
+            if not execution.finished:
+                execution.kill()
+        if check and execution.returncode != 0:
+            raise CommandFailed(cmd, execution.returncode, stderr_tail)
+
+    def iter_lines(self, cmd, timeout=None, max_bytes=None, check=True):
+        """
+        Run `cmd`, yielding lines of its standard output as they arrive
+
+        See `stream` for the meaning of the arguments, standard error output is only reported
+        as part of `CommandFailed`.
+
+        :return: Iterator[bytes], lines including the line terminator
+        """
+        pending = b''
+        for stream, data in self.stream(cmd, timeout, max_bytes, check):
+            if stream != Execution.STDOUT:
+                continue
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if pending:
+            yield pending
+
+    def run(self, cmd, timeout=None, max_bytes=None, check=True):
+        """
+        Run `cmd` and wait for it, see `stream` for the meaning of the arguments
+
+        :return: Tuple[bytes, bytes], standard and error output
+        """
+        output = {Execution.STDOUT: [], Execution.STDERR: []}
+        for stream, data in self.stream(cmd, timeout, max_bytes, check):
+            output[stream].append(data)
+        return b''.join(output[Execution.STDOUT]), b''.join(output[Execution.STDERR])
+
 
 class LocalDriver(Driver):
     def __init__(self):
@@ -17,4 +343,9 @@ class LocalDriver(Driver):
     def exec_command(self, cmd):
         args = shlex.split(cmd)
         p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if INSTRUMENTATION.enabled:
+            return CommandRecorder(INSTRUMENTATION, 'localhost', cmd, p.poll).wrap(p.stdin, p.stdout, p.stderr)
         return p.stdin, p.stdout, p.stderr
+
+    def exec_async(self, cmd, on_output=None):
+        return ProcessExecution(cmd, shlex.split(cmd), on_output)
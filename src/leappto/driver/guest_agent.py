@@ -0,0 +1,125 @@
+import base64
+import json
+import time
+from io import BytesIO
+
+import libvirt
+import libvirt_qemu
+
+from leappto.driver import Driver, Execution
+
+
+GUEST_AGENT_CHANNEL = 'org.qemu.guest_agent.0'
+
+
+class GuestAgentError(Exception):
+    pass
+
+
+class GuestAgentExecution(Execution):
+    """
+    Execution of a command started by `guest-exec`, the agent is polled for its status
+    """
+
+    _POLL_INTERVAL = 0.1
+
+    def __init__(self, cmd, driver, on_output=None):
+        super(GuestAgentExecution, self).__init__(cmd, on_output, driver.domain_name)
+        self._driver = driver
+        self._pid = driver._command('guest-exec', path='/bin/sh', arg=['-c', cmd],
+                                    **{'capture-output': True})['pid']
+
+    def fds(self):
+        return []
+
+    def step(self, timeout=None):
+        status = self._driver._command('guest-exec-status', pid=self._pid)
+        if not status['exited']:
+            time.sleep(self._POLL_INTERVAL if timeout is None else min(self._POLL_INTERVAL, timeout))
+            return
+        # The agent only hands out the output once the process exited
+        for stream, key in ((self.STDOUT, 'out-data'), (self.STDERR, 'err-data')):
+            if status.get(key):
+                self._emit(stream, base64.b64decode(status[key]))
+        self._finish(status.get('exitcode'))
+
+    def kill(self):
+        # guest-exec offers no way to terminate the process, it is abandoned
+        self._finish(None)
+
+
+class GuestAgentDriver(Driver):
+    """
+    Driver executing commands through the qemu guest agent of a libvirt domain
+
+    Besides `exec_command`, which is built on `guest-exec`, facts which the agent knows natively
+    are exposed as methods, so they can be collected without starting any process in the guest.
+    """
+
+    def __init__(self, domain, timeout=10):
+        super(GuestAgentDriver, self).__init__()
+        self._domain = domain
+        self._timeout = timeout
+
+    @property
+    def domain_name(self):
+        return self._domain.name()
+
+    @staticmethod
+    def is_available(root):
+        """
+        Check the domain has a connected guest agent channel
+
+        :param root: xml.etree.ElementTree.Element, parsed domain XML description
+        :return: bool
+        """
+        for target in root.findall("devices/channel/target[@name='{}']".format(GUEST_AGENT_CHANNEL)):
+            if target.get('state') == 'connected':
+                return True
+        return False
+
+    def _command(self, execute, **arguments):
+        cmd = {'execute': execute}
+        if arguments:
+            cmd['arguments'] = arguments
+        try:
+            result = libvirt_qemu.qemuAgentCommand(self._domain, json.dumps(cmd), self._timeout, 0)
+        except libvirt.libvirtError as e:
+            raise GuestAgentError('Guest agent command {} failed for {}: {}'.format(
+                execute, self._domain.name(), e))
+        return json.loads(result).get('return')
+
+    def ping(self):
+        try:
+            self._command('guest-ping')
+        except GuestAgentError:
+            return False
+        return True
+
+    def os_release(self):
+        """
+        :return: Tuple[str, str], distribution name and version
+        """
+        info = self._command('guest-get-osinfo')
+        return info.get('name') or info.get('id'), info.get('version-id') or info.get('version')
+
+    def hostname(self):
+        return self._command('guest-get-host-name')['host-name']
+
+    def interface_addresses(self):
+        """
+        :return: Dict[str, dict], interface addresses in the format of `virDomain.interfaceAddresses`
+        """
+        try:
+            return self._domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT)
+        except libvirt.libvirtError as e:
+            raise GuestAgentError('Failed to get interface addresses of {}: {}'.format(self._domain.name(), e))
+
+    def exec_command(self, cmd):
+        execution = self.exec_async(cmd)
+        while not execution.finished:
+            execution.step()
+        return BytesIO(), BytesIO(execution.stdout), BytesIO(execution.stderr)
+
+    def exec_async(self, cmd, on_output=None):
+        return GuestAgentExecution(cmd, self, on_output)
@@ -0,0 +1,274 @@
+import os
+import threading
+import time
+
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_SKIPPED_WORDS = ('sudo', 'env', 'nohup', 'exec')
+
+
+def command_class(cmd):
+    """
+    Name commands are aggregated by, the program being run
+
+    :param cmd: str, command line
+    :return: str, e.g. `rsync` for `sudo rsync -a / target:/`
+    """
+    for word in cmd.split():
+        if word in _SKIPPED_WORDS or word.startswith('-') or ('=' in word and not word.startswith('=')):
+            continue
+        return os.path.basename(word.strip('\'"')) or word
+    return ''
+
+
+def command_size(cmd):
+    """
+    :param cmd: str, command line
+    :return: int, number of bytes the command line takes on the wire
+    """
+    return len(cmd if isinstance(cmd, bytes) else cmd.encode('utf-8'))
+
+
+class Histogram(object):
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        index = 0
+        while index < len(self._bounds) and value > self._bounds[index]:
+            index += 1
+        self._counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def _to_dict(self):
+        buckets = [[str(bound), count] for bound, count in zip(self._bounds, self._counts)]
+        buckets.append(['+Inf', self._counts[-1]])
+        return {'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max, 'buckets': buckets}
+
+
+class _Aggregate(object):
+    """
+    Statistics of the commands and connection phases of one host or one command class
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.duration = Histogram()
+        self.first_byte = Histogram()
+        self.phases = {}
+
+    def add_command(self, duration, first_byte, bytes_in, bytes_out, returncode):
+        self.commands += 1
+        if returncode is not None and returncode != 0:
+            self.failures += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.duration.add(duration)
+        if first_byte is not None:
+            self.first_byte.add(first_byte)
+
+    def add_phase(self, phase, duration):
+        self.phases.setdefault(phase, Histogram()).add(duration)
+
+    def _to_dict(self):
+        return {'commands': self.commands, 'failures': self.failures, 'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out, 'duration': self.duration._to_dict(),
+                'first_byte': self.first_byte._to_dict(),
+                'phases': dict((phase, h._to_dict()) for phase, h in self.phases.items())}
+
+
+class Instrumentation(object):
+    """
+    Collects timings of commands run by drivers and of setting up their connections
+
+    Recording is disabled until `enable` is called, so uninstrumented runs pay a single
+    attribute check per command. Listeners added with `add_listener` are called with every
+    event as a dict, besides the events are aggregated per host and per command class.
+
+    Command events carry `duration` (start to end), `first_byte` (start to the first byte of
+    output, i.e. remote startup and network latency), `bytes_in` (output received), `bytes_out`
+    (command line and standard input sent, probes and helpers travel in the command line) and `returncode`
+    (None if the command was killed or its status is not known, only non-zero statuses count
+    as failures). Phase events carry the
+    `phase` (`connect`, `handshake`, `auth`, `channel_open`, `master_setup`) and its `duration`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._hosts = {}
+        self._classes = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def add_listener(self, listener):
+        """
+        :param listener: callable, called with each event dict
+        """
+        self._listeners.append(listener)
+
+    def _emit(self, event):
+        for listener in self._listeners:
+            listener(event)
+
+    def record_command(self, host, cmd, duration, first_byte=None, bytes_in=0, bytes_out=0, returncode=None):
+        if not self.enabled:
+            return
+        name = command_class(cmd)
+        with self._lock:
+            for aggregates, key in ((self._hosts, host), (self._classes, name)):
+                aggregates.setdefault(key, _Aggregate()).add_command(duration, first_byte, bytes_in, bytes_out,
+                                                                     returncode)
+        self._emit({'event': 'command', 'host': host, 'command': name, 'duration': duration,
+                    'first_byte': first_byte, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                    'returncode': returncode})
+
+    def record_phase(self, host, phase, duration):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._hosts.setdefault(host, _Aggregate()).add_phase(phase, duration)
+        self._emit({'event': 'phase', 'host': host, 'phase': phase, 'duration': duration})
+
+    def phase(self, host, phase):
+        """
+        Context manager recording the duration of its block as connection `phase` of `host`
+        """
+        return _PhaseTimer(self, host, phase)
+
+    def summary(self):
+        """
+        :return: dict, JSON serializable aggregates per host and per command class
+        """
+        with self._lock:
+            return {'hosts': dict((host, a._to_dict()) for host, a in self._hosts.items()),
+                    'commands': dict((name, a._to_dict()) for name, a in self._classes.items())}
+
+    def reset(self):
+        with self._lock:
+            self._hosts = {}
+            self._classes = {}
+
+
+class _PhaseTimer(object):
+    def __init__(self, instrumentation, host, phase):
+        self._instrumentation = instrumentation
+        self._host = host
+        self._phase = phase
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._instrumentation.record_phase(self._host, self._phase, time.time() - self._start)
+
+
+class CommandRecorder(object):
+    """
+    Accounting of a single command run through `Driver.exec_command`
+
+    The file objects handed out are wrapped, the command is recorded when its standard
+    output reaches the end or is closed.
+    """
+
+    def __init__(self, instrumentation, host, cmd, status=None):
+        """
+        :param status: callable, returns the exit status of the command or None if it is not known yet
+        """
+        self._instrumentation = instrumentation
+        self._host = host
+        self._cmd = cmd
+        self._status = status
+        self._start = time.time()
+        self._first_byte = None
+        self._recorded = False
+        self.bytes_in = 0
+        self.bytes_out = command_size(cmd)
+
+    def received(self, size):
+        if size and self._first_byte is None:
+            self._first_byte = time.time() - self._start
+        self.bytes_in += size
+
+    def finish(self):
+        if self._recorded:
+            return
+        self._recorded = True
+        returncode = self._status() if self._status is not None else None
+        self._instrumentation.record_command(self._host, self._cmd, time.time() - self._start, self._first_byte,
+                                             self.bytes_in, self.bytes_out, returncode)
+
+    def wrap(self, stdin, stdout, stderr):
+        return _CountingWriter(stdin, self), _CountingReader(stdout, self, True), _CountingReader(stderr, self)
+
+
+class _FileProxy(object):
+    def __init__(self, f, recorder):
+        self._file = f
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class _CountingReader(_FileProxy):
+    def __init__(self, f, recorder, finishes=False):
+        super(_CountingReader, self).__init__(f, recorder)
+        self._finishes = finishes
+
+    def _count(self, data, requested=True):
+        self._recorder.received(len(data))
+        if not data and requested and self._finishes:
+            self._recorder.finish()
+        return data
+
+    def read(self, *args):
+        data = self._file.read(*args)
+        return self._count(data, not args or args[0] != 0)
+
+    def readline(self, *args):
+        return self._count(self._file.readline(*args))
+
+    def readlines(self, *args):
+        lines = self._file.readlines(*args)
+        self._recorder.received(sum(len(line) for line in lines))
+        if self._finishes and not args:
+            self._recorder.finish()
+        return lines
+
+    def __iter__(self):
+        for line in self._file:
+            self._recorder.received(len(line))
+            yield line
+        if self._finishes:
+            self._recorder.finish()
+
+    def close(self):
+        if self._finishes:
+            self._recorder.finish()
+        self._file.close()
+
+
+class _CountingWriter(_FileProxy):
+    def write(self, data):
+        self._recorder.bytes_out += len(data)
+        return self._file.write(data)
+
+
+INSTRUMENTATION = Instrumentation()
@@ -1,18 +1,33 @@
+import atexit
+import binascii
 import getpass
 import json
 import os
 import shlex
 import socket
+import subprocess
+import threading
+import time
+import weakref
 
 try:
-    from pipes import quote
-except ImportError:
-    from shelx import quote
+    string_types = basestring
+except NameError:
+    string_types = str
 
 
 import paramiko
 
-from leappto.driver import Driver, LocalDriver
+from leappto.cache import AgentKeyMemo
+from leappto.driver import Driver, Execution, ProcessExecution
+from leappto.driver.instrumentation import INSTRUMENTATION, CommandRecorder
+
+
+# Control sockets of the OpenSSH master connections, shared with the migration commands
+SSH_CTL_PATH = os.path.expanduser('~/.ssh/ctl')
+SSH_CONTROL_PATH = os.path.join(SSH_CTL_PATH, '%L-%r@%h:%p')
+# Seconds an idle master connection is kept around
+SSH_CONTROL_PERSIST = 300
 
 
 class SSHError(Exception):
@@ -31,28 +46,55 @@ class SSHAuthenticationError(SSHError):
     pass
 
 
+KNOWN_HOSTS_PATH = os.path.expanduser('~/.ssh/known_hosts')
+
+# Agent keys accepted by the destinations, kept across runs so one-shot scans benefit as well
+_AGENT_KEY_MEMO = AgentKeyMemo()
+atexit.register(_AGENT_KEY_MEMO.save)
+
+
+def _load_host_keys(path=KNOWN_HOSTS_PATH):
+    """
+    Load known host keys, only needed with strict host key checking
+
+    :param path: str, path of the known_hosts file
+    :return: paramiko.hostkeys.HostKeys
+    """
+    try:
+        return paramiko.util.load_host_keys(path)
+    except IOError:
+        return paramiko.hostkeys.HostKeys()
+
+
+def _key_fingerprint(key):
+    return binascii.hexlify(key.get_fingerprint()).decode('ascii')
+
+
 class ParamikoConnection(object):
-    def __init__(self, hostname, username=None, port=22, strict_host_key=False):
+    def __init__(self, hostname, username=None, port=22, strict_host_key=False, timeout=None, identity=None):
+        self.hostname = hostname
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
         try:
-            self._socket.connect((hostname, port))
+            with INSTRUMENTATION.phase(hostname, 'connect'):
+                self._socket.connect((hostname, port))
         except socket.error as e:
             raise SSHConnectionError('Failed to connect to {}:{} ERROR: {}'.format(hostname, port, e))
         self._transport = paramiko.Transport(self._socket)
+        self._channels = weakref.WeakSet()
+        self.last_used = time.time()
+        # Number of drivers holding the connection, see `ConnectionPool.get`
+        self.leases = 0
 
         try:
-            self._transport.start_client()
+            with INSTRUMENTATION.phase(hostname, 'handshake'):
+                self._transport.start_client()
         except paramiko.SSHException:
             raise SSHConnectionError('SSH negotiation failed while connecting to: {}:{}'.format(hostname, port))
 
-        try:
-            host_keys = paramiko.util.load_host_keys(os.path.expanduser('~/.ssh/known_hosts'))
-        except IOError:
-            host_keys = paramiko.hostkeys.HostKeys()
-
         if strict_host_key:
             remote_key = self._transport.get_remote_server_key()
-            if not host_keys.check(hostname, remote_key):
+            if not _load_host_keys().check(hostname, remote_key):
                 raise SSHHostKeyError(
                         'Could not find {} - {} in known hosts for host {}'.format(
                             remote_key.get_name(),
@@ -62,44 +104,230 @@ class ParamikoConnection(object):
                 pass #  OK
 
         self.username = username or getpass.getuser()
-        agent_keys = paramiko.Agent().get_keys()
-        for key in agent_keys:
+        with INSTRUMENTATION.phase(hostname, 'auth'):
+            self._authenticate(hostname, port, identity)
+
+    def _authenticate(self, hostname, port, identity):
+        destination = '{}@{}:{}'.format(self.username, hostname, port)
+        # Try the agent key accepted last time first, saving a failed round trip per preceding key
+        known_good = _AGENT_KEY_MEMO.lookup(destination)
+        keys = sorted(paramiko.Agent().get_keys(), key=lambda k: _key_fingerprint(k) != known_good)
+        if identity:
+            keys.insert(0, self._load_identity(identity))
+        for key in keys:
             try:
                 self._transport.auth_publickey(self.username, key)
+                if not identity or key is not keys[0]:
+                    _AGENT_KEY_MEMO.store(destination, _key_fingerprint(key))
                 break
             except paramiko.SSHException:
                 pass
         if not self._transport.is_authenticated():
             raise SSHAuthenticationError('Could not find auth key for {}@{}'.format(self.username, hostname))
 
+    @staticmethod
+    def _load_identity(path):
+        key_classes = [paramiko.RSAKey, paramiko.ECDSAKey, paramiko.DSSKey]
+        if hasattr(paramiko, 'Ed25519Key'):
+            key_classes.append(paramiko.Ed25519Key)
+        for key_class in key_classes:
+            try:
+                return key_class.from_private_key_file(path)
+            except paramiko.SSHException:
+                pass
+            except IOError as e:
+                raise SSHAuthenticationError('Could not read identity file {}: {}'.format(path, e))
+        raise SSHAuthenticationError('Unsupported identity file: {}'.format(path))
+
+    def is_active(self):
+        return self._transport.is_active()
+
+    def in_use(self):
+        """
+        Check whether any channel opened over the connection is still open
+        """
+        return any(not chan.closed for chan in list(self._channels))
+
+    def close(self):
+        self._transport.close()
+
+    def _open_channel(self):
+        self.last_used = time.time()
+        with INSTRUMENTATION.phase(self.hostname, 'channel_open'):
+            chan = self._transport.open_session()
+        self._channels.add(chan)
+        return chan
 
     def exec_command(self, cmd, *args, **kwargs):
-        chan = self._transport.open_session()
+        chan = self._open_channel()
         chan.exec_command(cmd)
         stdin = chan.makefile('wb', 1)
         stdout = chan.makefile('r', 1)
         stderr = chan.makefile_stderr('r', 1)
+        if INSTRUMENTATION.enabled:
+            status = lambda: chan.recv_exit_status() if chan.exit_status_ready() else None
+            return CommandRecorder(INSTRUMENTATION, self.hostname, cmd, status).wrap(stdin, stdout, stderr)
         return stdin, stdout, stderr
 
+    def exec_async(self, cmd, on_output=None):
+        return ChannelExecution(cmd, self._open_channel(), on_output, self.hostname)
+
+
+class ChannelExecution(Execution):
+    """
+    Execution of a command in a paramiko channel
+    """
+
+    def __init__(self, cmd, channel, on_output=None, host=None):
+        super(ChannelExecution, self).__init__(cmd, on_output, host)
+        self._channel = channel
+        channel.exec_command(cmd)
+        channel.shutdown_write()
+
+    def fds(self):
+        return [] if self.finished else [self._channel.fileno()]
+
+    def handle(self, fd):
+        chan = self._channel
+        # Checked first, the transport thread may queue the last output and the end of it
+        # while the buffers are drained, the output arriving before the end is drained then
+        eof = chan.eof_received or chan.closed
+        # `on_output` may kill the execution
+        while not self.finished and chan.recv_ready():
+            self._emit(self.STDOUT, chan.recv(self._READ_SIZE))
+        while not self.finished and chan.recv_stderr_ready():
+            self._emit(self.STDERR, chan.recv_stderr(self._READ_SIZE))
+        if eof and not self.finished:
+            # The exit status follows the end of output immediately
+            self._finish(chan.recv_exit_status())
+            chan.close()
+
+    def kill(self):
+        self._channel.close()
+        self._finish(None)
+
+
+class ConnectionPool(object):
+    """
+    Authenticated SSH connections shared by all drivers talking to the same endpoint
+
+    Connections are keyed by (hostname, port, username, identity). Every command runs in its
+    own channel, so one transport serves any number of drivers and threads. Connections not
+    used for `idle_timeout` seconds are closed, as are the least recently used ones once there
+    are more than `max_size` of them, but never while a channel is open over them or a driver
+    still holds them. Each connection handed out by `get` is leased until it is passed to `release`.
+    """
+
+    def __init__(self, max_size=16, idle_timeout=300):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def get(self, hostname, username=None, port=22, identity=None, timeout=None):
+        """
+        Get connection to the endpoint, connecting unless there is a usable one in the pool
+
+        :param hostname: str, host to connect to
+        :param username: str, remote user, defaults to the local one
+        :param port: int, SSH port
+        :param identity: str, path of the private key to try before the agent keys
+        :param timeout: float, socket timeout of a new connection
+        :return: ParamikoConnection, leased to the caller
+        """
+        key = (hostname, port, username or getpass.getuser(), identity)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None and not connection.is_active():
+                del self._connections[key]
+                connection = None
+        if connection is None:
+            # Connect outside of the lock, so a slow host does not block all others
+            connection = ParamikoConnection(hostname, username=username, port=port, timeout=timeout,
+                                            identity=identity)
+            with self._lock:
+                existing = self._connections.get(key)
+                if existing is not None and existing.is_active():
+                    connection.close()
+                    connection = existing
+                else:
+                    self._connections[key] = connection
+                connection.leases += 1
+        else:
+            with self._lock:
+                connection.leases += 1
+        connection.last_used = time.time()
+        self._evict(key)
+        return connection
+
+    def release(self, connection):
+        """
+        Give back a connection returned by `get`, it may be evicted once no driver holds it anymore
+
+        :param connection: ParamikoConnection
+        """
+        with self._lock:
+            connection.leases -= 1
+        self._evict(None)
+
+    def _evict(self, keep):
+        now = time.time()
+        with self._lock:
+            idle = sorted((connection.last_used, key) for key, connection in self._connections.items()
+                          if key != keep and not connection.leases and not connection.in_use())
+            excess = len(self._connections) - self._max_size
+            evicted = []
+            for last_used, key in idle:
+                if now - last_used > self._idle_timeout or excess > 0:
+                    evicted.append(self._connections.pop(key))
+                    excess -= 1
+        for connection in evicted:
+            connection.close()
+
+    def close(self):
+        """
+        Close all connections
+        """
+        with self._lock:
+            connections, self._connections = list(self._connections.values()), {}
+        for connection in connections:
+            connection.close()
+
+
+CONNECTION_POOL = ConnectionPool()
+atexit.register(CONNECTION_POOL.close)
+
 
 class SSHConfig(object):
     def __init__(self, hostname, username=None, port=22, strict_host_key_checking=False, identity_file=None,
                  use_pass=False, control_path=None, options=None):
-        self._options = options or {}
+        self.hostname = hostname
+        self._options = dict(options or {})
         self._add_opt('User', username)
-        self._add_opt('IdentityFile', username)
-        self._add_opt('Host', hostname)
+        self._add_opt('IdentityFile', identity_file)
         self._add_opt('Port', port, int)
         self._add_opt('PasswordAuthentication', 'yes' if use_pass else 'no')
         self._add_opt('StrictHostKeyChecking', 'yes' if strict_host_key_checking else 'no')
         self._add_opt('ControlPath', control_path)
 
-    def ssh_cmd(self, *args, **kwargs):
+    def ssh_options(self, **kwargs):
+        """
+        :param kwargs: additional or overridden ssh options
+        :return: List[str], ssh command line options
+        """
         options = self._options.copy()
         options.update(kwargs)
-        return ['ssh'] + [e for l in [['-v', '{}={}'.format(k, v)] for k, v in options.items] for e in l] + list(args)
+        return [e for l in [['-o', '{}={}'.format(k, v)] for k, v in sorted(options.items())] for e in l]
 
-    def _add_opt(self, name, value, value_type=basestring):
+    def ssh_cmd(self, *args, **kwargs):
+        """
+        :param args: arguments following the hostname, i.e. the remote command
+        :param kwargs: additional or overridden ssh options
+        :return: List[str], ssh command line
+        """
+        return ['ssh'] + self.ssh_options(**kwargs) + [self.hostname] + list(args)
+
+    def _add_opt(self, name, value, value_type=string_types):
         if value:
             if not value_type or isinstance(value, value_type):
                 self._options[name] = value
@@ -107,26 +335,109 @@ class SSHConfig(object):
                 raise TypeError('{} should be of type {}'.format(name, value_type.__name__))
 
 
-class SSHConnection(LocalDriver):
-    def __init__(self, config):
+class SSHConnection(object):
+    """
+    Connection using the OpenSSH client
+
+    A master connection is set up once per host and every command is multiplexed over it,
+    so only the first command pays for the handshake. The master outlives the connection
+    object by `SSH_CONTROL_PERSIST` idle seconds and is shared by all ssh clients using the
+    same control path, e.g. the migration commands.
+    """
+
+    def __init__(self, config, timeout=None):
         self._config = config
-        super(LocalDriver, self).__init__()
+        self._shared = {'ControlMaster': 'auto', 'ControlPersist': SSH_CONTROL_PERSIST}
+        if timeout:
+            self._shared['ConnectTimeout'] = int(timeout)
+        self._start_master()
+
+    def _control(self, command):
+        child = ['ssh', '-O', command] + self._config.ssh_options(**self._shared) + [self._config.hostname]
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.Popen(child, stdout=devnull, stderr=devnull).wait()
+
+    def _start_master(self):
+        try:
+            os.makedirs(SSH_CTL_PATH)
+        except OSError:
+            if not os.path.isdir(SSH_CTL_PATH):
+                raise
+        if self.is_active():
+            return
+        # The first session becomes the master, which detaches from it thanks to ControlPersist
+        with INSTRUMENTATION.phase(self._config.hostname, 'master_setup'):
+            child = subprocess.Popen(self._config.ssh_cmd('true', **self._shared),
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _, errors = child.communicate()
+        if child.returncode != 0:
+            raise SSHConnectionError('Failed to connect to {}: {}'.format(
+                self._config.hostname, errors.decode('utf-8', 'replace').strip()))
+
+    def is_active(self):
+        return self._control('check') == 0
+
+    def close(self):
+        """
+        Stop the master connection
+        """
+        self._control('exit')
+
     def exec_command(self, cmd, *args, **kwargs):
-        return super(SSHConnection, self).exec_command('ssh ' +  self._target + ' ' + quote(cmd), *args)
+        child = subprocess.Popen(self._config.ssh_cmd(cmd, **self._shared),
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if INSTRUMENTATION.enabled:
+            recorder = CommandRecorder(INSTRUMENTATION, self._config.hostname, cmd, child.poll)
+            return recorder.wrap(child.stdin, child.stdout, child.stderr)
+        return child.stdin, child.stdout, child.stderr
+
+    def exec_async(self, cmd, on_output=None):
+        return ProcessExecution(cmd, self._config.ssh_cmd(cmd, **self._shared), on_output, self._config.hostname)
 
 
 class VagrantSSHDriver(Driver):
-    def __init__(self, domain_name):
-        self._connection = VagrantSSHDriver._get_vagrant_ssh_client_for_domain(domain_name)
+    def __init__(self, domain_name, timeout=None):
+        super(VagrantSSHDriver, self).__init__()
+        self._timeout = timeout
+        self._args = VagrantSSHDriver._get_vagrant_ssh_args_from_domain(domain_name)
+        if not self._args:
+            raise SSHConnectionError('Could not find vagrant SSH configuration for {}'.format(domain_name))
+        self._connection = self._get_connection()
+
+    def _get_connection(self):
+        return CONNECTION_POOL.get(self._args['hostname'], username=self._args.get('username'),
+                                   port=self._args.get('port', 22), identity=self._args.get('key_filename'),
+                                   timeout=self._timeout)
+
+    def _active_connection(self):
+        if self._connection is None:
+            raise SSHConnectionError('Driver of {} is closed'.format(self._args['hostname']))
+        if not self._connection.is_active():
+            CONNECTION_POOL.release(self._connection)
+            self._connection = None
+            self._connection = self._get_connection()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            CONNECTION_POOL.release(self._connection)
+            self._connection = None
 
     def exec_command(self, *args, **kwargs):
-        return self._connection.exec_command(*args, **kwargs)
+        return self._active_connection().exec_command(*args, **kwargs)
+
+    def exec_async(self, cmd, on_output=None):
+        return self._active_connection().exec_async(cmd, on_output)
 
     @staticmethod
     def _get_vagrant_data_path_from_domain(domain_name):
         index_path = os.path.join(os.environ['HOME'], '.vagrant.d/data/machine-index/index')
-        index = json.load(open(index_path, 'r'))
-        for ident, machine in index['machines'].iteritems():
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except (IOError, ValueError) as e:
+            raise SSHConnectionError('Could not read vagrant machine index {}: {}'.format(index_path, e))
+        for ident, machine in index.get('machines', {}).items():
             path_name = os.path.basename(machine['vagrantfile_path'])
             vagrant_name = machine.get('name', 'default')
             if domain_name == path_name + '_' + vagrant_name:
@@ -136,13 +447,18 @@ class VagrantSSHDriver(Driver):
     @staticmethod
     def _get_vagrant_ssh_args_from_domain(domain_name):
         path = VagrantSSHDriver._get_vagrant_data_path_from_domain(domain_name)
+        if path is None:
+            raise SSHConnectionError('Domain {} is not a vagrant machine'.format(domain_name))
         path = os.path.join(path, 'provisioners/ansible/inventory/vagrant_ansible_inventory')
-        with open(path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line[0] in (';', '#'):
-                    continue
-                return VagrantSSHDriver._parse_ansible_inventory_data(line)
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line[0] in (';', '#'):
+                        continue
+                    return VagrantSSHDriver._parse_ansible_inventory_data(line)
+        except IOError as e:
+            raise SSHConnectionError('Could not read vagrant SSH configuration of {}: {}'.format(domain_name, e))
         return None
 
     @staticmethod
@@ -162,25 +478,36 @@ class VagrantSSHDriver(Driver):
                 args[mapping[key][0]] = mapping[key][1](value)
         return args
 
-    @staticmethod
-    def _get_vagrant_ssh_client_for_domain(domain_name):
-        args = VagrantSSHDriver._get_vagrant_ssh_args_from_domain(domain_name)
-        if args:
-            client = paramiko.SSHClient()
-            client.load_system_host_keys()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(args.pop('hostname'), **args)
-            return client
-        return None
-
 
 class SSHDriver(Driver):
-    def __init__(self, hostname, username=None, port=22, use_paramiko=True):
+    def __init__(self, hostname, username=None, port=22, use_paramiko=True, timeout=None, identity=None):
         super(SSHDriver, self).__init__()
         if use_paramiko:
-            self._connection = ParamikoConnection(hostname, username=username, port=port)
+            self._endpoint = dict(hostname=hostname, username=username, port=port, identity=identity, timeout=timeout)
+            self._connection = CONNECTION_POOL.get(**self._endpoint)
         else:
-            self._connection = SSHConnection(hostname, username=username, port=port)
+            self._endpoint = None
+            config = SSHConfig(hostname, username=username, port=port, identity_file=identity,
+                               control_path=SSH_CONTROL_PATH)
+            self._connection = SSHConnection(config, timeout=timeout)
+
+    def _active_connection(self):
+        if self._connection is None:
+            raise SSHConnectionError('Driver of {} is closed'.format(self._endpoint['hostname']))
+        if self._endpoint is not None and not self._connection.is_active():
+            # Dropped by the peer meanwhile
+            CONNECTION_POOL.release(self._connection)
+            self._connection = None
+            self._connection = CONNECTION_POOL.get(**self._endpoint)
+        return self._connection
+
+    def close(self):
+        if self._endpoint is not None and self._connection is not None:
+            CONNECTION_POOL.release(self._connection)
+            self._connection = None
 
     def exec_command(self, *args, **kwargs):
-        return self._connection.exec_command(*args, **kwargs)
+        return self._active_connection().exec_command(*args, **kwargs)
+
+    def exec_async(self, cmd, on_output=None):
+        return self._active_connection().exec_async(cmd, on_output)
@@ -4,18 +4,37 @@ import errno
 import json
 import libvirt
 import os
+import re
 import shlex
 import socket
+import sys
+import threading
+from collections import OrderedDict
 from io import BytesIO
 from subprocess import check_output
 from xml.etree import ElementTree as ET
 
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
 from leappto import AbstractMachineProvider, MachineType, Machine, Disk, \
-        Package, OperatingSystem, Installation
+        Package, OperatingSystem, Installation, MachineLookupError
+from leappto.cache import domain_fingerprint
+from leappto.driver.guest_agent import GuestAgentDriver, GuestAgentError
 from leappto.driver.ssh import VagrantSSHDriver
-from leappto.providers.ssh import inspect_machine
+from leappto.driver import DriverError
+from leappto.providers.ssh import InspectionError, inspect_machine
+from leappto.utils import matches_any, parallel_map
+
+# Guest interfaces whose addresses are reported, matches the filter used when inspecting over SSH
+_GUEST_INTERFACE_RE = re.compile(r'(wl|e(th|n|m))')
+
 
 class LibvirtMachine(Machine):
+    __slots__ = ()
+
     # TODO: Libvirt Python API doesn't seem to expose
     # virDomainSuspend and virDomainResume so use Virsh
     # for the time being
@@ -27,12 +46,29 @@ class LibvirtMachine(Machine):
 
 
 class LibvirtMachineProvider(AbstractMachineProvider):
-    def __init__(self, shallow_scan=True):
+    # Levels of detail of the machine descriptions
+    SCAN_LIBVIRT = 0
+    SCAN_GUEST = 1
+    SCAN_PACKAGES = 2
+
+    # Ways of inspecting guests
+    INSPECT_AUTO = 'auto'
+    INSPECT_SSH = 'ssh'
+    INSPECT_AGENT = 'agent'
+
+    def __init__(self, shallow_scan=True, jobs=1, cache=None, inspect_guests=True, inspector=INSPECT_AUTO,
+                 package_cache=None, timeout=None):
         self._connection = libvirt.open('qemu:///system')
         self._shallow_scan = shallow_scan
+        self._package_cache = package_cache
+        self._timeout = timeout
+        self._inspect_guests = inspect_guests
+        self._inspector = inspector
+        self._jobs = jobs
+        self._cache = cache
         # Stupid `libvirt` cannot carry out certain *read only* operations while
-        # being in read-only mode so just use `open` and fix this later by enumerating
-        # networks, checking the MAC of the domain and correlating this against DHCP leases
+        # being in read-only mode so just use `open`. Addresses of guests which are not
+        # inspected are found by correlating the MACs of the domain against DHCP leases
         # self._connection = libvirt.openReadOnly('qemu:///system')
 
     @property
@@ -44,78 +80,490 @@ class LibvirtMachineProvider(AbstractMachineProvider):
             self._connection.close()
         del self._connection
 
-    def get_machines(self):
+    @property
+    def scan_depth(self):
+        """
+        Level of detail of the machine descriptions, one of the `SCAN_*` constants
+        """
+        if not self._inspect_guests:
+            return self.SCAN_LIBVIRT
+        return self.SCAN_GUEST if self._shallow_scan else self.SCAN_PACKAGES
+
+    @staticmethod
+    def _get_attribute(elem, attr):
+        """
+        Get attribute if we have valid element
+
+        :param elem: xml.etree.ElementTree.Element, element
+        :param attr: str, attribute name
+        :return: str, attribute value
+        """
+        if elem is not None:
+            return elem.get(attr)
+
+    @staticmethod
+    def _get_storage(disks):
+        """
+        Get `Disk` objects from XML
+
+        :param disks: List[xml.etree.ElementTree.Element], disk xml elements
+        :return: List[Disk], list of Disks
+        """
+        storage = []
+        for disk in disks:
+            type_ = disk.get('type')
+            backing_file = LibvirtMachineProvider._get_attribute(disk.find('source[@file]'), 'file')
+            driver_type = LibvirtMachineProvider._get_attribute(disk.find('driver[@type]'), 'type')
+            device = LibvirtMachineProvider._get_attribute(disk.find('target[@dev]'), 'dev')
+            storage.append(Disk(type_, backing_file, device, driver_type))
+        return storage
+
+    @staticmethod
+    def _get_ipv4_addresses(interfaces, name_re=None):
+        """
+        Get IPv4 addresses from the result of `virDomain.interfaceAddresses`
+
+        :param interfaces: Dict[str, dict], interface addresses reported by libvirt
+        :param name_re: regular expression object, only interfaces with a matching name are used
+        :return: List[str], list of addresses
+        """
+        ips = []
+        for name, iface in sorted((interfaces or {}).items()):
+            if name_re and not name_re.search(name):
+                continue
+            for addr in iface.get('addrs') or []:
+                if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4 and addr['addr'] not in ips:
+                    ips.append(addr['addr'])
+        return ips
+
+    def _network_leases(self, network, leases):
+        """
+        IPv4 DHCP leases of a libvirt network by MAC, fetched only once for each `leases` table
+
+        :param network: str, network name
+        :param leases: Dict[str, Dict[str, List[dict]]], leases fetched so far by network
+        :return: Dict[str, List[dict]], leases by lower case MAC
+        """
+        if network not in leases:
+            by_mac = {}
+            try:
+                for lease in self.connection.networkLookupByName(network).DHCPLeases():
+                    if lease['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                        by_mac.setdefault(lease['mac'].lower(), []).append(lease)
+            except libvirt.libvirtError:
+                pass
+            leases[network] = by_mac
+        return leases[network]
+
+    def _lookup_addresses(self, domain, root, leases=None):
+        """
+        Find addresses of a domain without connecting to the guest
+
+        DHCP leases of the libvirt networks the domain is attached to are correlated with the
+        MACs of its interfaces, which also yields the hostname the guest sent to the DHCP server.
+        When there are no leases, libvirt is asked for the interface addresses directly.
+
+        :param domain: libvirt.virDomain, Domain for which to fetch the addresses
+        :param root: xml.etree.ElementTree.Element, parsed domain XML description
+        :param leases: dict, table of leases shared by the lookups of one scan, see `_network_leases`
+        :return: Tuple[List[str], str], list of IPv4 addresses and hostname (or None)
+        """
+        if leases is None:
+            leases = {}
+        ips, hostname = [], None
+        networks = {}
+        for iface in root.findall("devices/interface[@type='network']"):
+            mac = self._get_attribute(iface.find('mac'), 'address')
+            network = self._get_attribute(iface.find('source'), 'network')
+            if mac and network:
+                networks.setdefault(network, set()).add(mac.lower())
+
+        for network, macs in sorted(networks.items()):
+            by_mac = self._network_leases(network, leases)
+            for mac in sorted(macs):
+                for lease in by_mac.get(mac, []):
+                    if lease['ipaddr'] not in ips:
+                        ips.append(lease['ipaddr'])
+                    hostname = hostname or lease.get('hostname')
+
+        if not ips:
+            try:
+                ips = self._get_ipv4_addresses(
+                    domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE))
+            except libvirt.libvirtError:
+                pass
+        return ips, hostname
+
+    def _inspect_via_agent(self, domain):
+        """
+        Inspect the guest through the qemu guest agent
+
+        Shallow scans use the facts the agent knows natively. Deep scans, and agents lacking
+        `guest-get-osinfo`, run the inspection probe with a single `guest-exec`.
+
+        :param domain: libvirt.virDomain, Domain to inspect
+        :return: Tuple[List[str], str, Installation], addresses, hostname and installation
+        :raises: GuestAgentError, also when the probe run by the agent fails, e.g. without python in the guest
+        """
+        agent = GuestAgentDriver(domain)
+        try:
+            if not self._shallow_scan:
+                return inspect_machine(agent, False, self._package_cache, timeout=self._timeout)
+            try:
+                distro, version = agent.os_release()
+            except GuestAgentError:
+                return inspect_machine(agent, True, timeout=self._timeout)
+        except (InspectionError, DriverError, KeyError, ValueError) as e:
+            raise GuestAgentError('Inspection through the guest agent failed: {}'.format(e))
+        hostname = agent.hostname()
+        ips = self._get_ipv4_addresses(agent.interface_addresses(), _GUEST_INTERFACE_RE)
+        return ips, hostname, Installation(OperatingSystem(distro, version), [])
+
+    def _inspect_guest(self, domain, root):
+        """
+        Inspect the guest with the configured inspector
+
+        In `auto` mode the guest agent is preferred when the domain has a connected agent
+        channel, any agent failure falls back to SSH.
+
+        :param domain: libvirt.virDomain, Domain to inspect
+        :param root: xml.etree.ElementTree.Element, parsed domain XML description
+        :return: Tuple[List[str], str, Installation], addresses, hostname and installation
+        """
+        if self._inspector == self.INSPECT_AGENT or \
+                (self._inspector == self.INSPECT_AUTO and GuestAgentDriver.is_available(root)):
+            try:
+                return self._inspect_via_agent(domain)
+            except GuestAgentError:
+                if self._inspector == self.INSPECT_AGENT:
+                    raise
+        vagrant_driver = VagrantSSHDriver(domain.name(), timeout=self._timeout)
+        try:
+            return inspect_machine(vagrant_driver, self._shallow_scan, self._package_cache, timeout=self._timeout)
+        finally:
+            vagrant_driver.close()
+
+    def _domain_info(self, domain, use_cache=True, leases=None):
+        """
+        Create `Machine` description out of `virDomain` object
+
+        :param domain: libvirt.virDomain, Domain for which to fetch the information
+        :param use_cache: bool, whether a cached description may be used instead of inspecting the guest
+        :param leases: dict, table of leases shared by the lookups of one scan, see `_network_leases`
+        """
+        desc = domain.XMLDesc()
+        if self._cache:
+            fingerprint = domain_fingerprint(desc)
+        if self._cache and use_cache:
+            cached = self._cache.lookup(domain.UUIDString(), fingerprint, self.scan_depth)
+            if cached:
+                return LibvirtMachine._from_dict(cached, self)
+        root = ET.fromstring(desc)
+
+        os_type = root.find('os/type')
+        typ = next(os_type.itertext())
+        vt = MachineType.Default
+
+        if 'kvm' in root.get('type'):
+            vt |= MachineType.Kvm
+        if 'hvm' in typ:
+            vt |= MachineType.Hvm
+
+        '''
+        Too much log spew and doesn't work
+
+        try:
+            # This can fail on a number of occasions:
+            # 1) Theres no guest agent installed
+            # 2) The connection doesn't support the call
+            hostname = domain.hostname()
+        except libvirt.libvirtError:
+            hostname = None
+        '''
+
+        if self._inspect_guests:
+            ips, hostname, inst = self._inspect_guest(domain, root)
+        else:
+            ips, hostname = self._lookup_addresses(domain, root, leases)
+            os_ = OperatingSystem(None, None)
+            if self._inspector != self.INSPECT_SSH and GuestAgentDriver.is_available(root):
+                # The agent doesn't need a session in the guest, so the scan stays cheap
+                agent = GuestAgentDriver(domain)
+                try:
+                    os_ = OperatingSystem(*agent.os_release())
+                    hostname = agent.hostname()
+                except GuestAgentError:
+                    pass
+            hostname = hostname or domain.name()
+            inst = Installation(os_, [])
+
+        storage = self._get_storage(root.findall("devices/disk[@device='disk']"))
+
+        machine = LibvirtMachine(domain.UUIDString(), hostname,
+                                 ips, os_type.get('arch'), vt, storage,
+                                 next(root.find('name').itertext()), inst, self)
+        if self._cache:
+            self._cache.store(domain.UUIDString(), fingerprint, self.scan_depth, machine._to_dict())
+        return machine
+
+    def _try_domain_info(self, domain, leases=None):
+        try:
+            return self._domain_info(domain, leases=leases)
+        except Exception as e:
+            sys.stderr.write('Failed to inspect domain {}: {}\n'.format(domain.name(), e))
+            return None
+
+    def _domain_matches(self, domain, patterns, leases=None):
+        """
+        Check whether domain matches any of the patterns without inspecting the guest
+
+        Patterns are matched against the domain name, UUID and the hostname announced
+        in the DHCP leases of the domain.
+
+        :param domain: libvirt.virDomain, Domain to check
+        :param patterns: List[str], glob patterns
+        :param leases: dict, table of leases shared by the lookups of one scan, see `_network_leases`
+        :return: bool
+        """
+        if not patterns or '*' in patterns:
+            return True
+        if matches_any([domain.name(), domain.UUIDString()], patterns):
+            return True
+        _, hostname = self._lookup_addresses(domain, ET.fromstring(domain.XMLDesc()), leases)
+        return matches_any([hostname], patterns)
+
+    def find_machine(self, name):
+        """
+        Find a single active machine by domain name, UUID, hostname or address
+
+        Domains whose name, UUID, DHCP lease hostname or lease address match `name` are
+        inspected first. Only when none of them matches are the remaining domains inspected
+        one by one, comparing the hostname reported by the guest, until the first match.
+
+        :param name: str, domain name, UUID, hostname or IP address
+        :return: Machine, matching machine or None
+        :raises: MachineLookupError, when domains match `name` but none of them can be inspected
+        """
+        candidates, others = [], []
+        leases = {}
+        for domain in self.connection.listAllDomains(0):
+            if not domain.isActive():
+                continue
+            if name in (domain.name(), domain.UUIDString()):
+                candidates.append(domain)
+                continue
+            ips, hostname = self._lookup_addresses(domain, ET.fromstring(domain.XMLDesc()), leases)
+            if name == hostname or name in ips:
+                candidates.append(domain)
+            else:
+                others.append(domain)
+
+        try:
+            errors = []
+            for domain in candidates:
+                try:
+                    return self._domain_info(domain, leases=leases)
+                except Exception as e:
+                    errors.append('{}: {}'.format(domain.name(), e))
+            if errors:
+                raise MachineLookupError('Machine {} could not be inspected ({})'.format(name, '; '.join(errors)))
+            for domain in others:
+                try:
+                    machine = self._domain_info(domain, leases=leases)
+                except Exception:
+                    # An unrelated guest which can't be inspected must not prevent the lookup
+                    continue
+                if machine.hostname == name or name in machine.ip:
+                    return machine
+            return None
+        finally:
+            if self._cache:
+                self._cache.save()
+
+    def get_machines(self, patterns=None):
         """
         Get `Machine` description for each active machine
 
+        Domains are inspected by up to `jobs` concurrent workers, the order of the
+        returned machines follows the order reported by libvirt. When an `InventoryCache`
+        is used, domains with a fresh cache entry matching their current XML description
+        are not inspected at all. Domains not matching `patterns` are skipped before
+        any inspection takes place.
+
+        A domain which can't be inspected is reported on standard error output and left out,
+        it doesn't affect the other domains.
+
+        :param patterns: List[str], glob patterns matched against domain name, UUID or DHCP hostname
         :return: List[Machine], List of machines running on the system
         """
+        # DHCP leases are fetched once per network and shared by the workers, concurrent workers
+        # may both fetch a network not fetched yet at worst
+        leases = {}
+        domains = [dom for dom in self.connection.listAllDomains(0)
+                   if dom.isActive() and self._domain_matches(dom, patterns, leases)]
+        try:
+            machines = parallel_map(lambda domain: self._try_domain_info(domain, leases), domains, self._jobs)
+            return [machine for machine in machines if machine is not None]
+        finally:
+            if self._cache:
+                self._cache.save()
+
+
+class LiveLibvirtMachineProvider(LibvirtMachineProvider):
+    """
+    Machine provider keeping an in-memory inventory up to date through libvirt domain events
+
+    The inventory is populated by a single full scan, afterwards domains are inspected when
+    they start or reboot and dropped when they stop, so `get_machines` never rescans. Domains
+    failing inspection or without an address yet are looked up again with growing delays.
+    """
+
+    # Retries span about 20 minutes, slow booting guests take several minutes to accept SSH connections
+    _MAX_RETRIES = 22
+    _RETRY_DELAY = 10
+    _MAX_RETRY_DELAY = 60
+
+    def __init__(self, shallow_scan=True, jobs=1, cache=None, inspect_guests=True,
+                 inspector=LibvirtMachineProvider.INSPECT_AUTO, package_cache=None, timeout=None):
+        # The event loop implementation has to be registered before the connection is opened
+        libvirt.virEventRegisterDefaultImpl()
+        super(LiveLibvirtMachineProvider, self).__init__(shallow_scan, jobs, cache, inspect_guests, inspector,
+                                                         package_cache, timeout)
+        self._machines = OrderedDict()
+        self._changed = threading.Condition()
+        self._generation = 0
+        self._running = True
+        self._requests = Queue()
+        self._callbacks = []
 
-        def __get_attribute(elem, attr):
-            """
-            Get attribute if we have valid element
-
-            :param elem: xml.etree.ElementTree.Element, element
-            :param attr: str, attribute name
-            :return: str, attribute value
-            """
-            if elem is not None:
-                return elem.get(attr)
-
-        def __get_storage(disks):
-            """
-            Get `Disk` objects from XML
-
-            :param disks: List[xml.etree.ElementTree.Element], disk xml elements
-            :return: List[Disk], list of Disks
-            """
-            storage = []
-            for disk in disks:
-                type_ = disk.get('type')
-                backing_file = __get_attribute(disk.find('source[@file]'), 'file')
-                driver_type = __get_attribute(disk.find('driver[@type]'), 'type')
-                device = __get_attribute(disk.find('target[@dev]'), 'dev')
-                storage.append(Disk(type_, backing_file, device, driver_type))
-            return storage
-
-        def __domain_info(domain):
-            """
-            Create `Machine` description out of `virDomain` object
-
-            :param domain: libvirt.virDomain, Domain for which to fetch the information
-            """
-            desc = domain.XMLDesc()
-            root = ET.fromstring(desc)
-
-            os_type = root.find('os/type')
-            typ = next(os_type.itertext())
-            vt = MachineType.Default
-
-            if 'kvm' in root.get('type'):
-                vt |= MachineType.Kvm
-            if 'hvm' in typ:
-                vt |= MachineType.Hvm
-
-            '''
-            Too much log spew and doesn't work
+        self._start_thread(self._run_event_loop)
+        self._start_thread(self._process_requests)
+        self._callbacks.append(self.connection.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle_event, None))
+        self._callbacks.append(self.connection.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, self._on_reboot_event, None))
 
+        for machine in super(LiveLibvirtMachineProvider, self).get_machines():
+            self._machines[machine.id] = machine
+        self._notify()
+        # Left out by the scan after failing inspection, or recorded before getting a DHCP lease
+        for domain in self.connection.listAllDomains(0):
+            uuid = domain.UUIDString()
+            if domain.isActive() and (uuid not in self._machines or not self._machines[uuid].ip):
+                self._retry(uuid, 0)
+
+    @staticmethod
+    def _start_thread(target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run_event_loop(self):
+        while self._running:
+            libvirt.virEventRunDefaultImpl()
+
+    def _on_lifecycle_event(self, connection, domain, event, detail, opaque):
+        if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+            self._requests.put((domain.UUIDString(), 0))
+        elif event in (libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_CRASHED,
+                       libvirt.VIR_DOMAIN_EVENT_UNDEFINED):
+            self._requests.put((domain.UUIDString(), None))
+
+    def _on_reboot_event(self, connection, domain, opaque):
+        self._requests.put((domain.UUIDString(), 0))
+
+    def _process_requests(self):
+        """
+        Handle domain updates queued by the event callbacks
+
+        Inspection is done here rather than in the callbacks so the event loop is never blocked
+        by a slow guest. Freshly started guests usually don't accept SSH connections yet and
+        don't have a DHCP lease, so failed inspections and machines without an address are retried.
+        """
+        while self._running:
+            uuid, attempt = self._requests.get()
+            if attempt is None:
+                with self._changed:
+                    self._machines.pop(uuid, None)
+                self._notify()
+                continue
             try:
-                # This can fail on a number of occasions:
-                # 1) Theres no guest agent installed
-                # 2) The connection doesn't support the call
-                hostname = domain.hostname()
-            except libvirt.libvirtError:
-                hostname = None
-            '''
+                domain = self.connection.lookupByUUIDString(uuid)
+                if not domain.isActive():
+                    continue
+                machine = self._domain_info(domain, use_cache=False)
+            except Exception as e:
+                if not self._retry(uuid, attempt):
+                    sys.stderr.write('Failed to inspect domain {}: {}\n'.format(uuid, e))
+                continue
+            with self._changed:
+                self._machines[uuid] = machine
+            self._notify()
+            if not machine.ip:
+                self._retry(uuid, attempt)
+
+    def _retry(self, uuid, attempt):
+        """
+        Queue the domain for inspection again after a delay growing with `attempt`
+
+        :return: bool, False when the domain was retried too many times already
+        """
+        if attempt >= self._MAX_RETRIES:
+            return False
+        delay = min(self._RETRY_DELAY * 2 ** attempt, self._MAX_RETRY_DELAY)
+        timer = threading.Timer(delay, self._requests.put, [(uuid, attempt + 1)])
+        timer.daemon = True
+        timer.start()
+        return True
 
-            vagrant_driver = VagrantSSHDriver(domain.name())
-            ips, hostname, inst = inspect_machine(vagrant_driver, self._shallow_scan)
+    def _notify(self):
+        if self._cache:
+            self._cache.save()
+        with self._changed:
+            self._generation += 1
+            self._changed.notify_all()
 
-            storage = __get_storage(root.findall("devices/disk[@device='disk']"))
+    def get_machines(self, patterns=None):
+        """
+        Get `Machine` description for each active machine from the live inventory
+
+        :param patterns: List[str], glob patterns matched against domain name, UUID or hostname
+        :return: List[Machine], List of machines running on the system
+        """
+        with self._changed:
+            machines = list(self._machines.values())
+        if not patterns or '*' in patterns:
+            return machines
+        return [m for m in machines if matches_any([m.name, m.id, m.hostname], patterns)]
 
-            return LibvirtMachine(domain.UUIDString(), hostname,
-                                  ips, os_type.get('arch'), vt, storage,
-                                  next(root.find('name').itertext()), inst, self)
+    def find_machine(self, name):
+        """
+        Find a single active machine in the live inventory
+
+        :param name: str, domain name, UUID, hostname or IP address
+        :return: Machine, matching machine or None
+        """
+        return AbstractMachineProvider.find_machine(self, name)
 
-        domains = self.connection.listAllDomains(0)
-        return [__domain_info(dom) for dom in domains if dom.isActive()]
+    def wait_for_change(self, generation=None, timeout=None):
+        """
+        Block until the inventory changes
+
+        :param generation: int, generation returned by the previous call, None returns immediately
+        :param timeout: float, maximum number of seconds to wait
+        :return: int, current generation of the inventory
+        """
+        with self._changed:
+            if generation is not None and generation == self._generation:
+                self._changed.wait(timeout)
+            return self._generation
+
+    def close(self):
+        """
+        Stop watching domain events
+        """
+        self._running = False
+        for callback_id in self._callbacks:
+            self.connection.domainEventDeregisterAny(callback_id)
+        self._callbacks = []
@@ -1,9 +1,56 @@
+import socket
+
+import psutil
+
 from leappto.driver import LocalDriver
-from leappto.providers.ssh import SSHMachine
+from leappto.providers.ssh import SSHMachine, _PROBE_FUNCTIONS, _HELPER_FUNCTIONS
 from leappto import MachineType, Machine
 
+
+class LocalHelper(object):
+    """
+    In-process counterpart of `RemoteHelper` for the machine leapp runs on
+
+    The functions of the remote probe and helper are executed right in this process, only
+    the addresses are taken from psutil instead of running `ip`, so the local machine is
+    inspected without starting any process.
+    """
+
+    def __init__(self):
+        self._functions = {}
+        exec(compile(_PROBE_FUNCTIONS + _HELPER_FUNCTIONS, '<leapp-probe>', 'exec'), self._functions)
+        self._functions['addresses'] = self._addresses
+
+    def _addresses(self):
+        interface_re = self._functions['INTERFACE_RE']
+        ips = []
+        for name, addresses in sorted(psutil.net_if_addrs().items()):
+            if interface_re.search(name):
+                ips.extend(address.address for address in addresses if address.family == socket.AF_INET)
+        return ips
+
+    def facts(self):
+        return self._functions['facts']()
+
+    def iter_packages(self):
+        """
+        :return: Iterator[Tuple[str, str]], names and versions of installed packages
+        """
+        packages = []
+        self._functions['packages'](packages.append)
+        return ((name, version) for name, version in packages)
+
+    def listening_ports(self, external=False):
+        return self._functions['listening_ports'](external)
+
+    def close(self):
+        pass
+
+
 class LocalMachine(SSHMachine):
-    def __init__(self, shallow_scan=True):
-        super(LocalMachine, self).__init__(LocalDriver())
-        self._type = MachineType.Local
+    __slots__ = ()
 
+    def __init__(self, shallow_scan=True, package_cache=None):
+        super(LocalMachine, self).__init__(LocalDriver(), shallow_scan=shallow_scan, package_cache=package_cache,
+                                           helper=LocalHelper())
+        self._type = MachineType.Local
@@ -1,37 +1,579 @@
+import base64
 import json
+import select
+import socket
+import threading
+import time
+from io import BytesIO
 
-from leappto.driver import Driver
+from leappto.driver import Driver, DriverError, Execution, OutputLimitExceeded, run_executions
 from leappto.driver.ssh import SSHDriver
+from leappto.utils import parallel_imap_unordered
 from leappto import AbstractMachineProvider, MachineType, Machine, Disk, \
-        Package, OperatingSystem, Installation
-
-
-def inspect_machine(driver, shallow):
-    cmd = """python -c 'import platform; print(chr(0xa).join(platform.linux_distribution()[:2]))'"""
-    _, output, _ = driver.exec_command(cmd)
-    distro, version = output.read().strip().replace('\r', '').split('\n', 1)
-    cmd = """python -c 'import socket; print(socket.gethostname())'"""
-    _, output, _ = driver.exec_command(cmd)
-    hostname = output.read().strip()
-    cmd = "bash -c \"/sbin/ip -4 -o addr list | grep -E '(wl|e(th|n|m))' | sed 's/.*inet \\([0-9\\.]\\+\\)\\/.*$/\\1/g'\""
-    _, output, stderr = driver.exec_command(cmd)
-    ips = [i.strip() for i in output.read().split('\n') if i.strip()]
-    packages = []
-    if not shallow:
-        cmd = "python -c \"import rpm, json; print(json.dumps([(app['name'], " + \
-                "'{e}:{v}-{r}.{a}'.format(e=app['epoch'] or 0, v=app['version'], " + \
-                "a=app['arch'], r=app['release'])) for app in rpm.ts().dbMatch()]))\""
-        _, output, _ = driver.exec_command(cmd)
-        packages = [Package(e[0], e[1]) for e in json.loads(output.read())]
-    return (ips, hostname, Installation(OperatingSystem(distro, version), packages))
+        OperatingSystem, Installation
+
+
+# Functions shared by the probe and the remote helper, they have to work with the
+# Python versions found on the machines to be migrated (2.6 and newer).
+_PROBE_FUNCTIONS = """
+import json, os, platform, re, socket, subprocess, sys
+
+RPMDB_FILES = ('/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite', '/usr/lib/sysimage/rpm/rpmdb.sqlite')
+MACHINE_ID_FILES = ('/etc/machine-id', '/var/lib/dbus/machine-id')
+INTERFACE_RE = re.compile('(wl|e(th|n|m))')
+
+def distribution():
+    try:
+        return list(platform.linux_distribution()[:2])
+    except AttributeError:
+        info = {}
+        for line in open('/etc/os-release'):
+            key, _, value = line.strip().partition('=')
+            info[key] = value.strip('"')
+        return [info.get('NAME', ''), info.get('VERSION_ID', '')]
+
+def addresses():
+    output = subprocess.Popen(['/sbin/ip', '-4', '-o', 'addr', 'list'], stdout=subprocess.PIPE).communicate()[0]
+    ips = []
+    for line in output.decode('utf-8').splitlines():
+        fields = line.split()
+        if len(fields) > 3 and INTERFACE_RE.search(fields[1]) and fields[2] == 'inet':
+            ips.append(fields[3].split('/')[0])
+    return ips
+
+def machine_id():
+    for path in MACHINE_ID_FILES:
+        try:
+            return open(path).read().strip()
+        except IOError:
+            pass
+    return None
+
+def rpmdb_fingerprint():
+    stats = []
+    for path in RPMDB_FILES:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats.append('{p}:{i}:{s}:{m!r}'.format(p=path, i=st.st_ino, s=st.st_size, m=st.st_mtime))
+    return ';'.join(stats) or None
+
+def facts():
+    return {'distribution': distribution(), 'hostname': socket.gethostname(), 'addresses': addresses(),
+            'machine_id': machine_id(), 'rpmdb': rpmdb_fingerprint()}
+
+def packages(write):
+    import rpm
+    count = 0
+    for app in rpm.ts().dbMatch():
+        version = '{e}:{v}-{r}.{a}'.format(e=app['epoch'] or 0, v=app['version'], r=app['release'], a=app['arch'])
+        write([app['name'], version])
+        count += 1
+    return count
+
+def write_record(record):
+    sys.stdout.write(json.dumps(record) + '\\n')
+"""
+
+# The first line of the output holds the facts, optionally followed by one line per
+# package and a trailer with the number of packages, so both ends can stream the
+# package inventory instead of holding all of it in memory.
+_PROBE_SCRIPT = _PROBE_FUNCTIONS + """
+write_record(facts())
+if PACKAGES:
+    write_record({'packages': packages(write_record)})
+"""
+
+# Further inspection functions offered by the helpers
+_HELPER_FUNCTIONS = """
+def is_loopback(address):
+    # Addresses are hex encoded in host byte order, 127.0.0.0/8, ::1 and ::ffff:127.0.0.0/104
+    return (len(address) == 8 and address.endswith('7F')) or address == '0' * 24 + '01000000' or \
+        (address.startswith('0' * 16 + 'FFFF0000') and address.endswith('7F'))
+
+def listening_ports(external=False):
+    ports = set()
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            lines = open(path).readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            address, port = fields[1].rsplit(':', 1)
+            if fields[3] == '0A' and not (external and is_loopback(address)):
+                ports.add(int(port, 16))
+    return sorted(ports)
+"""
+
+# Long running counterpart of the probe, answers requests read from stdin until it is closed.
+# Every request and response is a single line JSON document, responses carry the id of
+# their request. Package inventories are sent in chunks followed by the final result.
+_HELPER_SCRIPT = _PROBE_FUNCTIONS + _HELPER_FUNCTIONS + """
+OPERATIONS = {'facts': facts, 'listening_ports': listening_ports}
+
+def respond(response):
+    write_record(response)
+    sys.stdout.flush()
+
+def send_packages(request_id):
+    chunk = []
+    def write(record):
+        chunk.append(record)
+        if len(chunk) >= CHUNK_SIZE:
+            respond({'id': request_id, 'more': chunk})
+            del chunk[:]
+    count = packages(write)
+    if chunk:
+        respond({'id': request_id, 'more': chunk})
+    return count
+
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    request = json.loads(line)
+    try:
+        if request['op'] == 'packages':
+            result = send_packages(request['id'])
+        else:
+            result = OPERATIONS[request['op']](*request.get('args', []))
+        respond({'id': request['id'], 'result': result})
+    except Exception:
+        respond({'id': request['id'], 'error': '{0}: {1}'.format(request['op'], sys.exc_info()[1])})
+"""
+
+
+# Upper bound of the probe output, far above the inventory of any real machine
+_PROBE_MAX_BYTES = 64 * 1024 * 1024
+# Seconds a helper started without an inspection timeout waits for each response
+_HELPER_TIMEOUT = 60
+
+
+class InspectionError(Exception):
+    pass
+
+
+def _python_command(script, **params):
+    """
+    Build command running `script` with the remote Python interpreter
+
+    The script is passed base64 encoded, so it survives any shell quoting on the way.
+
+    :param script: str, Python source
+    :param params: values assigned to global variables of the script
+    :return: str, command line
+    """
+    header = ''.join('{} = {!r}\n'.format(name, value) for name, value in sorted(params.items()))
+    encoded = base64.b64encode((header + script).encode('utf-8')).decode('ascii')
+    return "python -c \"exec(__import__('base64').b64decode('{}'))\"".format(encoded)
+
+
+def _read_record(line, errors=None):
+    try:
+        return json.loads(line)
+    except ValueError:
+        details = errors.read().strip() if errors is not None else ''
+        raise InspectionError('Machine inspection failed: {}'.format(details or line.strip()))
+
+
+class RemoteHelper(object):
+    """
+    Client of the helper process running on the machine
+
+    The helper is started once over `driver` and then answers any number of requests over
+    the same channel, so there is no per request channel setup or interpreter startup.
+    Requests are serialized, the helper may be shared by threads. A response not arriving
+    within `timeout` seconds fails the request and leaves the helper unusable.
+    """
+
+    _CHUNK_SIZE = 500
+
+    def __init__(self, driver, timeout=None):
+        cmd = _python_command(_HELPER_SCRIPT, CHUNK_SIZE=self._CHUNK_SIZE)
+        self._stdin, self._stdout, self._stderr = driver.exec_command(cmd)
+        self._timeout = timeout
+        self._failed = None
+        channel = getattr(self._stdout, 'channel', None)
+        if channel is not None:
+            channel.settimeout(timeout)
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _readline(self):
+        if self._timeout is not None and getattr(self._stdout, 'channel', None) is None:
+            # Pipes of a local process, they are unbuffered so a pending line is always seen by select
+            if not select.select([self._stdout], [], [], self._timeout)[0]:
+                raise socket.timeout()
+        return self._stdout.readline()
+
+    def _send(self, op, args):
+        if self._failed is not None:
+            raise InspectionError('Helper is unusable after an earlier failure: {}'.format(self._failed))
+        self._next_id += 1
+        self._stdin.write(json.dumps({'id': self._next_id, 'op': op, 'args': list(args)}) + '\n')
+        self._stdin.flush()
+        return self._next_id
+
+    def _receive(self, request_id):
+        try:
+            line = self._readline()
+        except socket.timeout:
+            # The response may still arrive and would be taken for the response of the next request
+            self._failed = 'no response within {} seconds'.format(self._timeout)
+            raise InspectionError('Helper did not respond within {} seconds'.format(self._timeout))
+        response = _read_record(line, self._stderr)
+        if response.get('id') != request_id:
+            raise InspectionError('Unexpected helper response: {}'.format(response))
+        if 'error' in response:
+            raise InspectionError('Helper request failed: {}'.format(response['error']))
+        return response
+
+    def request(self, op, *args):
+        """
+        Send request to the helper and wait for its result
+
+        :param op: str, name of the operation
+        :param args: arguments of the operation
+        :return: result of the operation
+        """
+        with self._lock:
+            return self._receive(self._send(op, args))['result']
+
+    def iter_packages(self):
+        """
+        :return: Iterator[Tuple[str, str]], names and versions of installed packages
+        """
+        # Received completely before anything is yielded, the lock must not be held by an
+        # iteration which may be abandoned
+        packages = []
+        with self._lock:
+            request_id = self._send('packages', ())
+            while True:
+                response = self._receive(request_id)
+                if 'result' in response:
+                    break
+                packages.extend((name, version) for name, version in response['more'])
+        return iter(packages)
+
+    def facts(self):
+        return self.request('facts')
+
+    def listening_ports(self, external=False):
+        """
+        :param external: bool, leave out ports only listening on loopback addresses
+        :return: List[int], listening TCP ports
+        """
+        return self.request('listening_ports', external)
+
+    def close(self):
+        """
+        Terminate the helper by closing its input
+        """
+        channel = getattr(self._stdin, 'channel', None)
+        if channel is not None:
+            channel.shutdown_write()
+        else:
+            self._stdin.close()
+
+
+def _run_probe(driver, packages, helper=None, timeout=None):
+    """
+    Run the probe on the machine
+
+    :param driver: Driver, driver used to execute the probe on the machine
+    :param packages: bool, whether the package inventory should be collected
+    :param helper: RemoteHelper, helper answering instead of a probe run
+    :param timeout: float, deadline of the probe in seconds
+    :return: Tuple[dict, List[Tuple[str, str]]], facts and package names and versions
+    """
+    if helper is not None:
+        return helper.facts(), list(helper.iter_packages()) if packages else []
+    lines = driver.iter_lines(_python_command(_PROBE_SCRIPT, PACKAGES=packages), timeout=timeout,
+                              max_bytes=_PROBE_MAX_BYTES)
+    try:
+        result = _parse_probe_output(lines, packages)
+        # Wait for the probe to exit, so its exit status is checked
+        for _ in lines:
+            pass
+    except DriverError as e:
+        raise InspectionError('Machine inspection failed: {}'.format(e))
+    return result
+
+
+class _ProbeParser(object):
+    """
+    Parser of the probe output, fed line by line or by chunks as they arrive
+
+    Records are parsed as soon as their line is complete, so only the package list itself
+    is held in memory, never the raw output.
+    """
+
+    _ERROR_TAIL = 4096
+
+    def __init__(self, packages, max_bytes=None):
+        """
+        :param packages: bool, whether the output includes the package inventory
+        :param max_bytes: int, maximum number of bytes of output fed by `feed`
+        """
+        self._packages = packages
+        self._max_bytes = max_bytes
+        self._received = 0
+        self._pending = b''
+        self._facts = None
+        self._result = []
+        self._complete = False
+        self.errors = b''
+
+    def feed_line(self, line, errors=None):
+        """
+        :param line: bytes, line of the output
+        :param errors: file, error output of the probe, used in error messages
+        :return: bool, whether the output is complete, further lines are ignored
+        """
+        if self._complete:
+            return True
+        record = _read_record(line, errors)
+        if self._facts is None:
+            self._facts = record
+            self._complete = not self._packages
+        elif isinstance(record, dict):
+            self._complete = True
+        else:
+            self._result.append((record[0], record[1]))
+        return self._complete
+
+    def feed(self, stream, data):
+        """
+        Parse a chunk of output, the last error output is kept for error messages
+
+        :param stream: str, `Execution.STDOUT` or `Execution.STDERR`
+        :param data: bytes, the chunk
+        :raises: InspectionError, OutputLimitExceeded
+        """
+        if stream == Execution.STDERR:
+            self.errors = (self.errors + data)[-self._ERROR_TAIL:]
+            return
+        self._received += len(data)
+        if self._max_bytes is not None and self._received > self._max_bytes:
+            raise OutputLimitExceeded('Probe produced more than {} bytes of output'.format(self._max_bytes))
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self.feed_line(line)
+
+    def result(self, errors=None):
+        """
+        :param errors: file, error output of the probe, used in error messages
+        :return: Tuple[dict, List[Tuple[str, str]]], facts and package names and versions
+        :raises: InspectionError, when the output is incomplete
+        """
+        if self._pending:
+            self.feed_line(self._pending, errors)
+            self._pending = b''
+        if self._facts is None:
+            _read_record(b'', errors)
+        if not self._complete:
+            details = errors.read().strip() if errors is not None else 'incomplete package inventory'
+            raise InspectionError('Machine inspection failed: {}'.format(details))
+        return self._facts, self._result
+
+
+def _parse_probe_output(lines, packages, errors=None):
+    """
+    :param lines: Iterable[bytes], lines of the probe output, consumed up to the end of the records
+    :param packages: bool, whether the output includes the package inventory
+    :param errors: file, error output of the probe, used in error messages
+    :return: Tuple[dict, List[Tuple[str, str]]], facts and package names and versions
+    """
+    parser = _ProbeParser(packages)
+    for line in lines:
+        if parser.feed_line(line, errors):
+            break
+    return parser.result(errors)
+
+
+def inspect_machine(driver, shallow, package_cache=None, helper=None, timeout=None):
+    """
+    Inspect machine by running the probe over `driver`
+
+    The package inventory is parsed record by record while it is received. With a
+    `package_cache`, the probe first only reports the rpmdb fingerprint of the machine
+    and the inventory is transferred only when the cache has no match for it.
+
+    :param driver: Driver, driver used to execute the probe on the machine
+    :param shallow: bool, skip the package inventory
+    :param package_cache: leappto.cache.PackageCache, cache of package inventories
+    :param helper: RemoteHelper, helper running on the machine to use instead of the probe
+    :param timeout: float, deadline of each probe run in seconds
+    :return: Tuple[List[str], str, Installation], addresses, hostname and installation
+    """
+    use_cache = not shallow and package_cache is not None
+    facts, packages = _run_probe(driver, not shallow and not use_cache, helper, timeout)
+    if use_cache:
+        identity = facts.get('machine_id') or facts['hostname']
+        cached = package_cache.lookup(identity, facts.get('rpmdb'))
+        if cached is not None:
+            packages = cached
+        else:
+            facts, packages = _run_probe(driver, True, helper, timeout)
+            package_cache.store(identity, facts.get('rpmdb'), packages)
+    return _inspection_result(facts, packages)
+
+
+def _inspection_result(facts, packages):
+    distro, version = facts['distribution']
+    return (facts['addresses'], facts['hostname'], Installation(OperatingSystem(distro, version), packages))
+
+
+def _probe_machines(drivers, packages, timeout, jobs=None):
+    """
+    Run the probe on up to `jobs` of `drivers` at once, collecting the output by a single `run_executions` loop
+
+    The output is parsed while it arrives and a probe producing more than `_PROBE_MAX_BYTES` is killed.
+
+    :return: Iterator[Tuple[Driver, Tuple[dict, List[Tuple[str, str]]], Exception]], drivers with the
+             facts and packages or the error, in the order the probes finish
+    """
+    cmd = _python_command(_PROBE_SCRIPT, PACKAGES=packages)
+    probes, failures = {}, []
+
+    def _on_output(execution, stream, data):
+        parser = probes[execution][1]
+        try:
+            parser.feed(stream, data)
+        except (InspectionError, DriverError) as e:
+            probes[execution][2] = e
+            execution.kill()
+
+    def _start():
+        for driver in drivers:
+            try:
+                execution = driver.exec_async(cmd, _on_output)
+            except DriverError as e:
+                failures.append((driver, None, InspectionError('Machine inspection failed: {}'.format(e))))
+                continue
+            probes[execution] = [driver, _ProbeParser(packages, _PROBE_MAX_BYTES), None]
+            yield execution
+
+    for execution in run_executions(_start(), timeout, jobs):
+        for failure in failures:
+            yield failure
+        del failures[:]
+        driver, parser, error = probes.pop(execution)
+        try:
+            if error is not None:
+                raise InspectionError('Machine inspection failed: {}'.format(error))
+            if execution.timed_out:
+                raise InspectionError('Machine inspection did not finish in {} seconds'.format(timeout))
+            if execution.returncode != 0:
+                raise InspectionError('Machine inspection failed with exit status {}: {}'.format(
+                    execution.returncode, parser.errors.decode('utf-8', 'replace').strip()))
+            yield driver, parser.result(BytesIO(parser.errors)), None
+        except InspectionError as e:
+            yield driver, None, e
+    for failure in failures:
+        yield failure
+
+
+def inspect_machines(drivers, shallow, package_cache=None, timeout=None, jobs=None):
+    """
+    Inspect many machines at once from the calling thread
+
+    The probes are started on all machines and their output is collected by a single
+    `run_executions` loop, instead of a thread blocking on each machine. With a
+    `package_cache`, the inventory is only probed for in a second round on the machines
+    the cache has no match for, as `inspect_machine` does.
+
+    :param drivers: Iterable[Driver], drivers of the machines, they have to implement `exec_async`
+    :param shallow: bool, skip the package inventory
+    :param package_cache: leappto.cache.PackageCache, cache of package inventories
+    :param timeout: float, seconds after which unfinished probes fail
+    :param jobs: int, maximum number of probes running at once, unlimited if None
+    :return: Iterator[Tuple[Driver, Tuple[List[str], str, Installation], Exception]], drivers with
+             the results of `inspect_machine` or the error, in the order the inspections finish
+    """
+    use_cache = not shallow and package_cache is not None
+    missed = []
+    for driver, result, error in _probe_machines(drivers, not shallow and not use_cache, timeout, jobs):
+        if error is None and use_cache:
+            facts = result[0]
+            identity = facts.get('machine_id') or facts['hostname']
+            cached = package_cache.lookup(identity, facts.get('rpmdb'))
+            if cached is None:
+                missed.append(driver)
+                continue
+            result = facts, cached
+        yield driver, None if error else _inspection_result(*result), error
+    for driver, result, error in _probe_machines(missed, True, timeout, jobs):
+        if error is None:
+            facts, packages = result
+            package_cache.store(facts.get('machine_id') or facts['hostname'], facts.get('rpmdb'), packages)
+        yield driver, None if error else _inspection_result(*result), error
+
+
+def inspect_hosts(hosts, user=None, port=22, shallow=True, package_cache=None, jobs=1, timeout=None):
+    """
+    Connect to `hosts` by up to `jobs` threads, then inspect them by `inspect_machines`, `jobs` at once
+
+    :param hosts: Iterable[str], hosts to inspect
+    :param user: str, remote user
+    :param port: int, SSH port
+    :param shallow: bool, skip the package inventory
+    :param package_cache: leappto.cache.PackageCache, cache of package inventories
+    :param jobs: int, maximum number of connections set up and of probes running at once
+    :param timeout: float, deadline of each connection setup and each probe in seconds
+    :return: Iterator[Tuple[str, SSHMachine, Exception]], hosts with their machine or the error
+    """
+    drivers = {}
+    connect = lambda host: SSHDriver(host, user, port, timeout=timeout)
+    for host, driver, error in parallel_imap_unordered(connect, hosts, jobs, timeout):
+        if error is not None:
+            yield host, None, error
+        else:
+            drivers[driver] = host
+    for driver, inspection, error in inspect_machines(drivers, shallow, package_cache, timeout, jobs):
+        if error is not None:
+            driver.close()
+            yield drivers[driver], None, error
+        else:
+            yield drivers[driver], SSHMachine(driver, inspection=inspection), None
 
 
 class SSHMachine(Machine):
-    def __init__(self, host_or_driver, user=None, port=22, shallow_scan=True):
+    __slots__ = ('_driver', '_helper', '_timeout')
+
+    def __init__(self, host_or_driver, user=None, port=22, shallow_scan=True, package_cache=None, timeout=None,
+                 use_helper=None, helper=None, inspection=None):
+        """
+        :param use_helper: bool, inspect by a `RemoteHelper`, by default it is used when the package
+                           cache may require a second request, over SSH connections only
+        :param inspection: Tuple[List[str], str, Installation], result of `inspect_machine` when the
+                           machine was inspected already, e.g. by `inspect_machines`
+        """
         if isinstance(host_or_driver, Driver):
             self._driver = host_or_driver
         else:
-            self._driver = SSHDriver(host_or_driver, user, port)
-        ips, hostname, installation = inspect_machine(self._driver, shallow_scan)
+            self._driver = SSHDriver(host_or_driver, user, port, timeout=timeout)
+        self._timeout = timeout
+        if use_helper is None:
+            use_helper = inspection is None and not shallow_scan and package_cache is not None and \
+                isinstance(self._driver, SSHDriver)
+        if helper is None and use_helper:
+            helper = RemoteHelper(self._driver, timeout or _HELPER_TIMEOUT)
+        self._helper = helper
+        if inspection is None:
+            inspection = inspect_machine(self._driver, shallow_scan, package_cache, self._helper, timeout)
+        ips, hostname, installation = inspection
         super(SSHMachine, self).__init__(hostname, hostname, ips, 'x86_64', MachineType.SSH, [], hostname,
                                          installation, None)
+
+    @property
+    def helper(self):
+        """
+        Helper process on the machine answering inspection requests, started on first use
+        """
+        if self._helper is None:
+            self._helper = RemoteHelper(self._driver, self._timeout or _HELPER_TIMEOUT)
+        return self._helper
@@ -0,0 +1,213 @@
+import fnmatch
+import heapq
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+# Hosts of a single network `expand_addresses` accepts by default, a /16 network
+MAX_NETWORK_HOSTS = 1 << 16
+
+
+def matches_any(values, patterns):
+    """
+    Check whether any of `values` matches any of the shell-style `patterns`
+
+    :param values: Iterable[str], values to check, `None` values are skipped
+    :param patterns: Iterable[str], glob patterns
+    :return: bool
+    """
+    patterns = list(patterns)
+    return any(fnmatch.fnmatch(value, pattern) for value in values if value is not None for pattern in patterns)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def _run_parallel(func, items, jobs, timeout):
+    """
+    Run `func` for each of `items` in worker threads, yield (index, result, error) as they finish
+
+    An item still running after `timeout` seconds is reported with a `DeadlineExceeded` error,
+    its worker is abandoned (threads can't be interrupted) and a fresh one takes its place,
+    so a hung item never holds a slot of the pool.
+    """
+    pending = Queue()
+    for entry in enumerate(items):
+        pending.put(entry)
+    finished = Queue()
+    lock = threading.Lock()
+    started = {}
+    expired = set()
+
+    def _worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except Empty:
+                return
+            with lock:
+                started[index] = time.time()
+            try:
+                entry = (index, func(item), None)
+            except Exception:
+                entry = (index, None, sys.exc_info()[1])
+            with lock:
+                started.pop(index, None)
+                if index in expired:
+                    # A replacement worker was started already, this one would exceed the pool size
+                    return
+            finished.put(entry)
+
+    def _start_worker():
+        worker = threading.Thread(target=_worker)
+        worker.daemon = True
+        worker.start()
+
+    for _ in range(min(jobs, len(items))):
+        _start_worker()
+
+    remaining = len(items)
+    while remaining:
+        # Block with a timeout so the main thread stays responsive to Ctrl-C
+        try:
+            entry = finished.get(timeout=0.5)
+        except Empty:
+            entry = None
+        if entry is not None:
+            remaining -= 1
+            yield entry
+        if timeout is None:
+            continue
+        now = time.time()
+        with lock:
+            overdue = [index for index, start in started.items() if now - start > timeout]
+            for index in overdue:
+                del started[index]
+                expired.add(index)
+        for index in overdue:
+            remaining -= 1
+            _start_worker()
+            yield index, None, DeadlineExceeded('Deadline of {} seconds exceeded'.format(timeout))
+
+
+def parallel_imap_unordered(func, items, jobs=1, timeout=None):
+    """
+    Apply `func` to each of `items` using a bounded pool of worker threads, yielding results as they complete
+
+    :param func: callable, function taking a single item
+    :param items: Iterable, items to process
+    :param jobs: int, maximum number of concurrently running workers
+    :param timeout: float, maximum number of seconds `func` may take for a single item
+    :return: Iterator[Tuple[item, result, Exception]], the error is None on success
+    """
+    items = list(items)
+    for index, result, error in _run_parallel(func, items, max(jobs or 1, 1), timeout):
+        yield items[index], result, error
+
+
+def parallel_map(func, items, jobs=1):
+    """
+    Apply `func` to each of `items` using a bounded pool of worker threads
+
+    Results are returned in the order of `items` no matter in which order the workers
+    finish, so a slow item only delays its own result. If `func` raises for any item,
+    the exception of the first such item (in input order) is re-raised.
+
+    :param func: callable, function taking a single item
+    :param items: Iterable, items to process
+    :param jobs: int, maximum number of concurrently running workers
+    :return: List, results of `func` for each item
+    """
+    items = list(items)
+    if jobs is None or jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = {}
+    for index, result, error in _run_parallel(func, items, jobs, None):
+        if error is not None:
+            errors[index] = error
+        results[index] = result
+
+    if errors:
+        raise errors[min(errors)]
+    return results
+
+
+def balanced_partition(sizes, parts):
+    """
+    Split items into `parts` groups of about the same total size
+
+    Items are assigned largest first to the group with the smallest total so far (LPT
+    scheduling), which is within 4/3 of the optimum. Empty groups are dropped.
+
+    :param sizes: Dict[Any, int], size of each item
+    :param parts: int, maximum number of groups
+    :return: List[List[Any]], groups, largest total first
+    """
+    groups = [(0, index, []) for index in range(max(parts, 1))]
+    for item in sorted(sizes, key=lambda key: (-sizes[key], key)):
+        total, index, members = heapq.heappop(groups)
+        members.append(item)
+        heapq.heappush(groups, (total + sizes[item], index, members))
+    return [members for _, _, members in sorted(groups, key=lambda group: (-group[0], group[1])) if members]
+
+
+def expand_addresses(specs, max_network_hosts=MAX_NETWORK_HOSTS):
+    """
+    Expand address specifications into hosts
+
+    Each specification is a hostname or IPv4 address, an IPv4 network in CIDR notation
+    (network and broadcast addresses are skipped) or `@path` naming a file which lists
+    further specifications, one per line, `#` starts a comment.
+
+    Hosts are generated as the specifications are read, networks with more than
+    `max_network_hosts` hosts are rejected when they are reached.
+
+    :param specs: Iterable[str], address specifications
+    :param max_network_hosts: int, maximum number of hosts of a single network, None for no limit
+    :return: Iterator[str], hosts in the order given, without duplicates
+    """
+    seen = set()
+    for host in _expand_specs(specs, max_network_hosts):
+        if host not in seen:
+            seen.add(host)
+            yield host
+
+
+def _expand_specs(specs, max_network_hosts):
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        if spec.startswith('@'):
+            with open(spec[1:], 'r') as f:
+                for host in _expand_specs((line.split('#', 1)[0] for line in f), max_network_hosts):
+                    yield host
+        elif '/' in spec:
+            network, prefix = spec.split('/', 1)
+            prefix = int(prefix)
+            if not 0 <= prefix <= 32:
+                raise ValueError('Invalid network prefix: {}'.format(spec))
+            mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+            first = struct.unpack('!I', socket.inet_aton(network))[0] & mask
+            last = first | (~mask & 0xffffffff)
+            if prefix < 31:
+                first, last = first + 1, last - 1
+            if max_network_hosts is not None and last - first + 1 > max_network_hosts:
+                raise ValueError('Network {} has {} hosts, more than the limit of {}'.format(
+                    spec, last - first + 1, max_network_hosts))
+            addr = first
+            while addr <= last:
+                yield socket.inet_ntoa(struct.pack('!I', addr))
+                addr += 1
+        else:
+            yield spec
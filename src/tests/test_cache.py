@@ -0,0 +1,94 @@
+import json
+import time
+
+from leappto.cache import InventoryCache, PackageCache
+
+MACHINE = {'id': 'uuid-1', 'os': {'os': {'name': 'CentOS', 'version': '7'},
+                                  'packages': [{'name': 'bash', 'version': '4.2'}]}}
+
+
+def _shallow(machine):
+    return dict(machine, os=dict(machine['os'], packages=[]))
+
+
+def test_inventory_cache_round_trip(tmpdir):
+    path = str(tmpdir.join('inventory.json'))
+    cache = InventoryCache(path)
+    assert cache.lookup('uuid-1', 'fp', 1) is None
+    cache.store('uuid-1', 'fp', 2, MACHINE)
+    cache.save()
+
+    cache = InventoryCache(path)
+    assert cache.lookup('uuid-1', 'fp', 2) == MACHINE
+    # More detailed entries satisfy less detailed lookups without their packages
+    assert cache.lookup('uuid-1', 'fp', 1) == _shallow(MACHINE)
+    assert cache.lookup('uuid-1', 'fp', 3) is None
+    assert cache.lookup('uuid-1', 'changed', 2) is None
+    assert cache.lookup('uuid-2', 'fp', 2) is None
+
+
+def test_inventory_cache_refresh(tmpdir):
+    path = str(tmpdir.join('inventory.json'))
+    cache = InventoryCache(path)
+    cache.store('uuid-1', 'fp', 2, MACHINE)
+    cache.save()
+
+    cache = InventoryCache(path, refresh=True)
+    assert cache.lookup('uuid-1', 'fp', 2) is None
+    cache.store('uuid-1', 'fp', 1, _shallow(MACHINE))
+    cache.save()
+    assert InventoryCache(path).lookup('uuid-1', 'fp', 1) == _shallow(MACHINE)
+
+
+def test_inventory_cache_ttl(tmpdir):
+    path = tmpdir.join('inventory.json')
+    cache = InventoryCache(str(path), ttl=60)
+    cache.store('uuid-1', 'fp', 2, MACHINE)
+    cache.store('uuid-2', 'fp', 2, MACHINE)
+    cache.save()
+
+    data = json.loads(path.read())
+    data['machines']['uuid-1']['timestamp'] = time.time() - 120
+    path.write(json.dumps(data))
+    cache = InventoryCache(str(path), ttl=60)
+    assert cache.lookup('uuid-1', 'fp', 2) is None
+    assert cache.lookup('uuid-2', 'fp', 2) == MACHINE
+
+
+def test_inventory_cache_version(tmpdir):
+    path = tmpdir.join('inventory.json')
+    cache = InventoryCache(str(path))
+    cache.store('uuid-1', 'fp', 2, MACHINE)
+    cache.save()
+
+    data = json.loads(path.read())
+    data['version'] -= 1
+    path.write(json.dumps(data))
+    assert InventoryCache(str(path)).lookup('uuid-1', 'fp', 2) is None
+
+
+def test_inventory_cache_unreadable(tmpdir):
+    path = tmpdir.join('inventory.json')
+    path.write('{')
+    assert InventoryCache(str(path)).lookup('uuid-1', 'fp', 1) is None
+
+
+def test_package_cache_round_trip(tmpdir):
+    cache = PackageCache(str(tmpdir))
+    packages = [('bash', '4.2'), ('glibc', '2.17')]
+    assert cache.lookup('machine-id', 'fp') is None
+    cache.store('machine-id', 'fp', packages)
+
+    cache = PackageCache(str(tmpdir))
+    assert [tuple(package) for package in cache.lookup('machine-id', 'fp')] == packages
+    assert cache.lookup('other-id', 'fp') is None
+
+
+def test_package_cache_fingerprint(tmpdir):
+    cache = PackageCache(str(tmpdir))
+    cache.store('machine-id', 'fp', [('bash', '4.2')])
+    # Any rpm transaction changes the fingerprint
+    assert cache.lookup('machine-id', 'changed') is None
+    assert cache.lookup('machine-id', None) is None
+    cache.store('other-id', None, [('bash', '4.2')])
+    assert len(tmpdir.listdir()) == 1
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import pytest
+
+from leappto.dedup import _DEDUP_SCRIPT, parse_dedup_output
+
+
+def _run_script(root, store, capsys):
+    """Run the dedup script in this interpreter, return its namespace and statistics"""
+    namespace = {'ROOT': root, 'STORE': store, 'DIRS': ('usr', 'lib')}
+    exec(compile(_DEDUP_SCRIPT, 'dedup', 'exec'), namespace)
+    return namespace, parse_dedup_output(capsys.readouterr()[0].encode('utf-8'))
+
+
+def _write(path, content, mode=0o644, mtime=1500000000):
+    path.write(content, ensure=True)
+    path.chmod(mode)
+    os.utime(str(path), (mtime, mtime))
+    return path
+
+
+def test_parse_dedup_output():
+    output = b'warning: something\n{"files": 3, "linked": 1, "bytes": 10, "errors": 0}\n'
+    assert parse_dedup_output(output) == {'files': 3, 'linked': 1, 'bytes': 10, 'errors': 0}
+    assert parse_dedup_output(b'') is None
+    assert parse_dedup_output(b'Traceback (most recent call last):\n') is None
+
+
+def test_dedup_key(tmpdir, capsys):
+    first = _write(tmpdir.join('a'), 'content')
+    namespace, _ = _run_script(str(tmpdir.join('empty')), str(tmpdir.join('store')), capsys)
+    object_key = namespace['object_key']
+
+    key = object_key(str(first), os.stat(str(first)))
+    assert key.startswith('ed7002b439e9ac845f22357d822bac1444730fbdb6016d3ec9432297b9ec9f73-644-')
+    same = _write(tmpdir.join('b'), 'content')
+    assert object_key(str(same), os.stat(str(same))) == key
+    # Hard links share all metadata, so any difference makes a different object
+    for path in (_write(tmpdir.join('c'), 'changed'), _write(tmpdir.join('d'), 'content', mode=0o755),
+                 _write(tmpdir.join('e'), 'content', mtime=1600000000)):
+        assert object_key(str(path), os.stat(str(path))) != key
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='hard links of the object store need Linux')
+def test_dedup_links_identical_files(tmpdir, capsys):
+    root, store = tmpdir.join('container'), tmpdir.join('store')
+    first = _write(root.join('usr', 'bin', 'tool'), 'content')
+    second = _write(root.join('lib', 'tool'), 'content')
+    other = _write(root.join('usr', 'bin', 'other'), 'content', mode=0o755)
+    _write(root.join('usr', 'empty'), '')
+    _write(root.join('etc', 'tool'), 'content')
+
+    _, stats = _run_script(str(root), str(store), capsys)
+    assert stats == {'files': 3, 'linked': 1, 'bytes': len('content'), 'errors': 0}
+    assert os.path.samefile(str(first), str(second))
+    assert not os.path.samefile(str(first), str(other))
+    assert os.stat(str(root.join('etc', 'tool'))).st_nlink == 1
+
+    # A second run finds everything linked already
+    _, stats = _run_script(str(root), str(store), capsys)
+    assert stats == {'files': 3, 'linked': 0, 'bytes': 0, 'errors': 0}
@@ -0,0 +1,30 @@
+from leappto import Installation, OperatingSystem, Package, PackageList
+
+DATA = {'os': {'name': 'CentOS', 'version': '7'},
+        'packages': [{'name': 'bash', 'version': '4.2'}, {'name': 'glibc', 'version': '2.17'}]}
+
+
+def test_installation_round_trip():
+    installation = Installation._from_dict(DATA)
+    assert installation.os.name == 'CentOS'
+    assert installation.os.version == '7'
+    assert installation._to_dict() == DATA
+
+
+def test_installation_packages():
+    installation = Installation(OperatingSystem('CentOS', '7'), [Package('bash', '4.2'), ('glibc', '2.17')])
+    packages = installation.packages
+    assert isinstance(packages, PackageList)
+    assert len(packages) == 2
+    assert [(pkg.name, pkg.version) for pkg in packages] == [('bash', '4.2'), ('glibc', '2.17')]
+    assert packages[-1].name == 'glibc'
+    assert [pkg.name for pkg in packages[:1]] == ['bash']
+    assert 'glibc' in [pkg.name for pkg in reversed(packages)]
+
+
+def test_installation_interns_strings():
+    # Built at runtime, literals would be shared by the compiler anyway
+    first = Installation(OperatingSystem('CentOS', '7'), [(''.join(['ba', 'sh']), '4.2')])
+    second = Installation._from_dict({'os': DATA['os'], 'packages': [{'name': ''.join(['bas', 'h']),
+                                                                      'version': '4.2'}]})
+    assert first.packages[0].name is second.packages[0].name
@@ -0,0 +1,77 @@
+import json
+from io import BytesIO
+
+import pytest
+
+from leappto.driver import Execution, OutputLimitExceeded
+from leappto.providers.ssh import InspectionError, _ProbeParser, _parse_probe_output
+
+FACTS = {'hostname': 'web', 'addresses': ['10.0.0.1'], 'distribution': ['CentOS', '7']}
+
+
+def _output(packages, end=True):
+    lines = [json.dumps(FACTS)] + [json.dumps(package) for package in packages]
+    if end:
+        lines.append(json.dumps({}))
+    return [line.encode('utf-8') for line in lines]
+
+
+def test_parse_probe_output():
+    facts, packages = _parse_probe_output(iter(_output([['bash', '4.2'], ['glibc', '2.17']])), True)
+    assert facts == FACTS
+    assert packages == [('bash', '4.2'), ('glibc', '2.17')]
+
+
+def test_parse_probe_output_stops_at_end():
+    lines = iter(_output([['bash', '4.2']]) + [b'trailing'])
+    _parse_probe_output(lines, True)
+    assert list(lines) == [b'trailing']
+
+
+def test_parse_probe_output_facts_only():
+    lines = iter(_output([]))
+    assert _parse_probe_output(lines, False) == (FACTS, [])
+    assert len(list(lines)) == 1
+
+
+def test_parse_probe_output_incomplete():
+    with pytest.raises(InspectionError) as info:
+        _parse_probe_output(_output([['bash', '4.2']], end=False), True, BytesIO(b'rpm: killed\n'))
+    assert 'rpm: killed' in str(info.value)
+
+
+def test_parse_probe_output_no_output():
+    with pytest.raises(InspectionError) as info:
+        _parse_probe_output([], True, BytesIO(b'python: command not found\n'))
+    assert 'python: command not found' in str(info.value)
+
+
+def test_probe_parser_chunks():
+    parser = _ProbeParser(True)
+    data = b'\n'.join(_output([['bash', '4.2'], ['glibc', '2.17']]))
+    for offset in range(0, len(data), 7):
+        parser.feed(Execution.STDOUT, data[offset:offset + 7])
+    parser.feed(Execution.STDERR, b'warning\n')
+    assert parser.result() == (FACTS, [('bash', '4.2'), ('glibc', '2.17')])
+    assert parser.errors == b'warning\n'
+
+
+def test_probe_parser_error_tail():
+    parser = _ProbeParser(True)
+    parser.feed(Execution.STDERR, b'x' * 10000)
+    parser.feed(Execution.STDERR, b'last')
+    assert len(parser.errors) == _ProbeParser._ERROR_TAIL
+    assert parser.errors.endswith(b'last')
+
+
+def test_probe_parser_byte_limit():
+    parser = _ProbeParser(True, max_bytes=100)
+    parser.feed(Execution.STDOUT, _output([])[0] + b'\n')
+    with pytest.raises(OutputLimitExceeded):
+        parser.feed(Execution.STDOUT, b'["bash", "4.2"]\n' * 10)
+
+
+def test_probe_parser_invalid_record():
+    parser = _ProbeParser(True)
+    with pytest.raises(InspectionError):
+        parser.feed(Execution.STDOUT, b'Traceback (most recent call last):\n')
@@ -0,0 +1,44 @@
+import pytest
+
+# leapp-tool needs the libvirt bindings and runs on Python 2 only
+pytest.importorskip('libvirt')
+pytest.importorskip('sets')
+
+from leappto.cli import _RSYNC_NOT_TRANSFERRED, _RSYNC_VANISHED, _merge_rsync_status, _parse_rsync_stats  # noqa: E402
+
+STATS_3_1 = b"""
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 12 (reg: 12)
+Number of regular files transferred: 1,012
+Total file size: 12,345,678 bytes
+Total transferred file size: 1,234,567 bytes
+"""
+
+STATS_3_0 = b"""
+Number of files: 1234
+Number of files transferred: 1012
+Total file size: 12345678 bytes
+Total transferred file size: 1234567 bytes
+"""
+
+
+@pytest.mark.parametrize('statuses,merged', [
+    ([], 0),
+    ([0, 0], 0),
+    ([0, _RSYNC_VANISHED], _RSYNC_VANISHED),
+    ([_RSYNC_VANISHED, _RSYNC_NOT_TRANSFERRED, _RSYNC_VANISHED], _RSYNC_NOT_TRANSFERRED),
+    ([_RSYNC_NOT_TRANSFERRED, 12], 12),
+    ([12, _RSYNC_NOT_TRANSFERRED, 11], 12),
+    ([0, 11, 0], 11),
+])
+def test_merge_rsync_status(statuses, merged):
+    assert _merge_rsync_status(statuses) == merged
+
+
+@pytest.mark.parametrize('output', [STATS_3_1, STATS_3_0, STATS_3_1.replace(b',', b'.')])
+def test_parse_rsync_stats(output):
+    assert _parse_rsync_stats(output) == {'files': 1012, 'bytes': 1234567}
+
+
+def test_parse_rsync_stats_missing():
+    assert _parse_rsync_stats(b'rsync error: some files could not be transferred\n') == {'files': 0, 'bytes': 0}
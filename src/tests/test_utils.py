@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from leappto.utils import DeadlineExceeded, balanced_partition, expand_addresses, parallel_imap_unordered
+
+
+def test_expand_addresses_hosts_and_networks():
+    hosts = expand_addresses(['web', ' 10.0.0.0/30 ', '', '10.0.0.1', '192.168.1.7/32', '172.16.0.0/31'])
+    assert list(hosts) == ['web', '10.0.0.1', '10.0.0.2', '192.168.1.7', '172.16.0.0', '172.16.0.1']
+
+
+def test_expand_addresses_files(tmpdir):
+    nested = tmpdir.join('nested')
+    nested.write('db # database\n')
+    hosts = tmpdir.join('hosts')
+    hosts.write('# fleet\nweb\n\n@{}\nweb\n'.format(nested))
+    assert list(expand_addresses(['@{}'.format(hosts), 'db'])) == ['web', 'db']
+
+
+def test_expand_addresses_is_lazy():
+    hosts = expand_addresses(['10.0.0.0/8'], max_network_hosts=None)
+    assert next(hosts) == '10.0.0.1'
+    assert next(hosts) == '10.0.0.2'
+
+
+@pytest.mark.parametrize('spec', ['10.0.0.0/33', '10.0.0.0/-1'])
+def test_expand_addresses_invalid_prefix(spec):
+    with pytest.raises(ValueError):
+        list(expand_addresses([spec]))
+
+
+def test_expand_addresses_network_limit():
+    assert len(list(expand_addresses(['10.0.0.0/16']))) == 65534
+    hosts = expand_addresses(['web', '10.0.0.0/24'], max_network_hosts=100)
+    assert next(hosts) == 'web'
+    with pytest.raises(ValueError):
+        next(hosts)
+
+
+def test_balanced_partition():
+    sizes = {'a': 10, 'b': 7, 'c': 5, 'd': 3, 'e': 1}
+    assert balanced_partition(sizes, 2) == [['a', 'd'], ['b', 'c', 'e']]
+    assert balanced_partition(sizes, 10) == [['a'], ['b'], ['c'], ['d'], ['e']]
+    assert balanced_partition(sizes, 0) == [['a', 'b', 'c', 'd', 'e']]
+    assert balanced_partition({}, 3) == []
+
+
+def test_parallel_imap_unordered_results_and_errors():
+    def _func(item):
+        if item == 3:
+            raise ValueError(item)
+        return item * 2
+
+    results = dict((item, (result, error)) for item, result, error in parallel_imap_unordered(_func, range(5), 2))
+    assert [results[item][0] for item in (0, 1, 2, 4)] == [0, 2, 4, 8]
+    assert isinstance(results[3][1], ValueError)
+
+
+def test_parallel_imap_unordered_deadline_replaces_worker():
+    release = threading.Event()
+
+    def _func(item):
+        if item == 'hung':
+            release.wait(5)
+            return 'late'
+        return item.upper()
+
+    started = time.time()
+    try:
+        results = list(parallel_imap_unordered(_func, ['hung', 'a', 'b'], jobs=1, timeout=0.2))
+    finally:
+        release.set()
+    # The only worker is stuck, the others are served by its replacement
+    assert time.time() - started < 4
+    assert [(item, result) for item, result, _ in results if item != 'hung'] == [('a', 'A'), ('b', 'B')]
+    hung = [(result, error) for item, result, error in results if item == 'hung']
+    assert len(hung) == 1
+    assert hung[0][0] is None
+    assert isinstance(hung[0][1], DeadlineExceeded)